@@ -24,6 +24,18 @@ class BaseConfig:
     DB_USER = os.getenv("DB_USER")
     DB_PASSWORD = os.getenv("DB_PASSWORD")
 
+    # Connection pool sizing / timeouts (seconds)
+    DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))
+    DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "50"))
+    DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "1800"))
+    # Recycle a connection after this many queries (bounds per-backend memory growth)
+    DB_POOL_MAX_QUERIES = int(os.getenv("DB_POOL_MAX_QUERIES", "50000"))
+    DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+    DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "2048"))
+    # JIT compilation only pays off for long analytical queries; the API runs short OLTP ones
+    DB_JIT = os.getenv("DB_JIT", "off")
+
     # Smart connection DISABLED temporarily for performance fix
     USE_SMART_DB_CONNECTION = False  # Force direct connections to avoid host detection delays
 
@@ -3,19 +3,83 @@ Database connection manager for PostgreSQL using asyncpg.
 Provides connection pooling and query utilities for FastAPI.
 """
 
+import asyncio
 import asyncpg
-from typing import Optional, List, Dict, Any
+import orjson
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional, List, Dict, Any
 from config.config import get_config
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def _encode_json(value: Any) -> str:
+    """Encode a Python value for a json / jsonb parameter."""
+    return orjson.dumps(value).decode("utf-8")
+
+
+class PoolBusyError(Exception):
+    """No pool connection became free within DB_ACQUIRE_TIMEOUT."""
+
+
 class DatabaseManager:
     """Manages PostgreSQL connection pool and provides query utilities."""
     
     _pool: Optional[asyncpg.Pool] = None
     _config = None
+    _hot_statements: List[str] = []
+    
+    @classmethod
+    def register_hot_statements(cls, *queries: str) -> None:
+        """
+        Register SQL that every new pool connection prepares up front.
+        
+        Call at module import time with the module-level SQL constants used
+        on hot paths; queries must be passed later with the exact same text
+        so they hit the connection's statement cache.
+        """
+        for query in queries:
+            if query not in cls._hot_statements:
+                cls._hot_statements.append(query)
+    
+    @classmethod
+    async def _init_connection(cls, connection: asyncpg.Connection):
+        """
+        Configure type codecs and prepare hot statements on every new pool connection.
+        
+        NUMERIC is decoded straight to float (and encoded from its string
+        form) so rows don't pay for Decimal construction and later casts.
+        JSON / JSONB (e.g. json_agg results) are decoded with orjson into
+        Python lists / dicts, so callers never re-parse JSON strings.
+        """
+        await connection.set_type_codec(
+            "numeric",
+            encoder=str,
+            decoder=float,
+            schema="pg_catalog",
+            format="text",
+        )
+        for json_type in ("json", "jsonb"):
+            await connection.set_type_codec(
+                json_type,
+                encoder=_encode_json,
+                decoder=orjson.loads,
+                schema="pg_catalog",
+                format="text",
+            )
+        
+        # asyncpg has no public API to pre-populate its per-connection
+        # statement cache: connection.prepare() bypasses it (use_cache=False),
+        # so fetch()/execute() would still re-prepare. _get_statement() is the
+        # cached path they use; it is private, hence the asyncpg upper bound
+        # in requirements.txt (re-check this call before raising it).
+        for query in cls._hot_statements:
+            try:
+                await connection._get_statement(query, None)
+            except Exception as e:
+                # Never block the pool on a bad statement; it'll fail on use
+                logger.warning(f"Could not prepare hot statement: {e}")
     
     @classmethod
     async def initialize(cls):
@@ -34,9 +98,14 @@ class DatabaseManager:
                 database=cls._config.DB_NAME,
                 user=cls._config.DB_USER,
                 password=cls._config.DB_PASSWORD,
-                min_size=2,  # Minimum number of connections
-                max_size=10,  # Maximum number of connections
-                command_timeout=60,  # Command timeout in seconds
+                min_size=cls._config.DB_POOL_MIN_SIZE,  # Minimum number of connections
+                max_size=cls._config.DB_POOL_MAX_SIZE,  # Maximum number of connections
+                max_inactive_connection_lifetime=cls._config.DB_POOL_MAX_INACTIVE_LIFETIME,
+                max_queries=cls._config.DB_POOL_MAX_QUERIES,
+                command_timeout=cls._config.DB_COMMAND_TIMEOUT,  # Command timeout in seconds
+                statement_cache_size=cls._config.DB_STATEMENT_CACHE_SIZE,
+                server_settings={'jit': cls._config.DB_JIT},
+                init=cls._init_connection,
             )
             logger.info("Database connection pool initialized successfully")
         except Exception as e:
@@ -58,6 +127,50 @@ class DatabaseManager:
             await cls.initialize()
         return cls._pool
     
+    @classmethod
+    def acquire_timeout(cls) -> float:
+        """Seconds a request may wait for a free pool connection before failing."""
+        return (cls._config or get_config()).DB_ACQUIRE_TIMEOUT
+    
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Acquire a pool connection, waiting at most acquire_timeout() seconds.
+        
+        Raises PoolBusyError when the wait runs out; timeouts of the queries
+        run on the connection are left as they are.
+        
+        Usage:
+            async with DatabaseManager.acquire() as conn:
+                await conn.fetch("SELECT ...")
+        """
+        pool = await cls.get_pool()
+        try:
+            connection = await pool.acquire(timeout=cls.acquire_timeout())
+        except asyncio.TimeoutError as e:
+            raise PoolBusyError("Timed out waiting for a database connection") from e
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+    
+    @classmethod
+    def pool_stats(cls) -> Dict[str, Any]:
+        """Current pool occupancy, for monitoring connection starvation."""
+        if cls._pool is None:
+            return {"initialized": False}
+        size = cls._pool.get_size()
+        idle = cls._pool.get_idle_size()
+        return {
+            "initialized": True,
+            "min_size": cls._pool.get_min_size(),
+            "max_size": cls._pool.get_max_size(),
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+        }
+    
     @classmethod
     async def fetch_all(cls, query: str, *args) -> List[Dict[str, Any]]:
         """
@@ -114,6 +227,9 @@ class DatabaseManager:
         """
         Execute a query multiple times with different parameters.
         
+        For bulk inserts prefer a single INSERT ... SELECT FROM unnest($n::type[])
+        statement, which sends every row in one round-trip.
+        
         Args:
             query: SQL query string
             args_list: List of tuples containing query parameters
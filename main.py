@@ -3,7 +3,8 @@ Main FastAPI application for Mykonos Backend.
 Handles database lifecycle and route configuration.
 """
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.exception_handlers import http_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
@@ -11,7 +12,8 @@ import logging
 import os
 
 from routes import products, groups, user, purchases, contact
-from config.db_connection import DatabaseManager
+from config.db_connection import DatabaseManager, PoolBusyError
+from utils.responses import ORJSONResponse, pool_busy_exception
 
 # Configure logging
 logging.basicConfig(
@@ -21,9 +23,10 @@ logger = logging.getLogger(__name__)
 
 
 import asyncio
-from utils.tasks import deactivate_expired_discounts, deactivate_expired_coupons
+from utils.tasks import deactivate_expired_discounts, deactivate_expired_coupons, refresh_waiting_list_stats
 from utils.order_tasks import cancel_expired_orders
 from utils.notification_tasks import cleanup_old_notifications_task
+from utils.email_tasks import run_email_worker, drain_email_queue
 
 
 @asynccontextmanager
@@ -67,6 +70,18 @@ async def lifespan(app: FastAPI):
                 logger.error(f"Error in order cancellation task: {e}")
                 await asyncio.sleep(60)  # Retry after 1 min on error
 
+    async def run_periodic_waiting_list_stats_refresh():
+        while True:
+            try:
+                await refresh_waiting_list_stats()
+                # Run every 5 minutes (300 seconds)
+                await asyncio.sleep(300)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in waiting list stats refresh task: {e}")
+                await asyncio.sleep(60)  # Retry after 1 min on error
+
     async def run_periodic_notification_cleanup():
         while True:
             try:
@@ -82,23 +97,32 @@ async def lifespan(app: FastAPI):
 
     cleanup_task = asyncio.create_task(run_periodic_cleanup())
     order_cancel_task = asyncio.create_task(run_periodic_order_cancellation())
+    waiting_list_stats_task = asyncio.create_task(run_periodic_waiting_list_stats_refresh())
     notification_cleanup_task = asyncio.create_task(run_periodic_notification_cleanup())
+    email_worker_task = asyncio.create_task(run_email_worker())
 
     logger.info(
-        "Background cleanup, order cancellation, and notification tasks started"
+        "Background cleanup, order cancellation, waiting list stats, notification and email tasks started"
     )
 
     yield
 
     # Shutdown
+    # Give queued emails a chance to go out before stopping the worker
+    await drain_email_queue()
+
     # Cancel background tasks
     cleanup_task.cancel()
     order_cancel_task.cancel()
+    waiting_list_stats_task.cancel()
     notification_cleanup_task.cancel()
+    email_worker_task.cancel()
     try:
         await cleanup_task
         await order_cancel_task
+        await waiting_list_stats_task
         await notification_cleanup_task
+        await email_worker_task
     except asyncio.CancelledError:
         pass
 
@@ -116,8 +140,22 @@ app = FastAPI(
     description="Backend API for Mykonos Virtual Store",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+
+
+@app.exception_handler(PoolBusyError)
+async def pool_busy_handler(request: Request, exc: PoolBusyError):
+    """
+    DatabaseManager.acquire() found no free pool connection within
+    DB_ACQUIRE_TIMEOUT: answer 503 + Retry-After rather than a bare 500.
+    Query timeouts are not caught here and stay server errors.
+    """
+    logger.warning("Database pool busy on %s %s", request.method, request.url.path)
+    return await http_exception_handler(request, pool_busy_exception())
+
+
 # CORS configuration
 origins = [
     "http://localhost:5173",
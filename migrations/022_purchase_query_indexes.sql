@@ -0,0 +1,18 @@
+-- Migration 022: Indexes for the purchase / order hot paths
+-- Backs the WHERE / ORDER BY clauses used by routes/purchases.py and utils/order_service.py.
+-- Note: images(product_id, orden) is already covered by idx_images_product_orden (005) and
+-- web_variant_branch_assignment(variant_id) by the uq_variant_branch unique constraint (004).
+
+-- "My purchases" listing: WHERE web_user_id = $1 ... ORDER BY sale_date DESC
+CREATE INDEX IF NOT EXISTS idx_sales_web_user_date ON sales (web_user_id, sale_date DESC);
+
+-- Sale items lookup by sale (purchase detail, confirmation emails)
+CREATE INDEX IF NOT EXISTS idx_sales_detail_sale ON sales_detail (sale_id);
+
+-- Reserved stock per variant at checkout: variant_id = $1 AND status = 'active' AND expires_at > now
+CREATE INDEX IF NOT EXISTS idx_stock_res_variant_active
+    ON stock_reservations (variant_id, expires_at)
+    WHERE status = 'active';
+
+-- Reservations of an order (confirm / cancel / expire): sale_id = $1 AND status = ...
+CREATE INDEX IF NOT EXISTS idx_stock_res_sale_status ON stock_reservations (sale_id, status);
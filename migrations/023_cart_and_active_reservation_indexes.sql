@@ -0,0 +1,13 @@
+-- Migration 023: Cart lookup and active-reservation indexes
+-- Backs the cart clear and reservation release/confirm run on every order confirm / cancel.
+
+-- Cart of a user: SELECT / DELETE ... WHERE cart_id IN (SELECT id FROM web_carts WHERE user_id = $1)
+CREATE INDEX IF NOT EXISTS idx_web_carts_user ON web_carts (user_id);
+CREATE INDEX IF NOT EXISTS idx_web_cart_items_cart ON web_cart_items (cart_id);
+
+-- Active reservations of an order: sale_id = $1 AND status = 'active'.
+-- Partial, so it skips the confirmed / cancelled / expired history that
+-- idx_stock_res_sale_status (022) still has to walk through.
+CREATE INDEX IF NOT EXISTS idx_stock_res_active_sale
+    ON stock_reservations (sale_id)
+    WHERE status = 'active';
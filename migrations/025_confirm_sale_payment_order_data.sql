@@ -0,0 +1,193 @@
+-- Migration 025: confirm_sale_payment() also returns the order / customer data
+-- The sale row is read (and locked) joined with its web user, and those
+-- columns are returned with the outcome, so the notification emails need no
+-- second read of sales + web_users after the confirmation.
+-- Outcomes are unchanged from migration 024:
+--   'confirmed'        payment applied (stock deducted, cart cleared, tracking added)
+--   'not_found'        no sale with that id
+--   'not_pending'      sale is not 'Pendiente' (sale_status has the current one)
+--   'expired'          reservation expired: the sale is cancelled and its reservations expired
+--   'no_reservations'  sale has no active reservations left
+
+-- The result columns change, so the function has to be dropped first
+DROP FUNCTION IF EXISTS confirm_sale_payment(INTEGER, TEXT, TEXT);
+
+CREATE FUNCTION confirm_sale_payment(
+    p_sale_id INTEGER,
+    p_payment_reference TEXT,
+    p_description TEXT
+)
+RETURNS TABLE (
+    outcome TEXT,
+    sale_status TEXT,
+    web_user_id INTEGER,
+    confirmed_at TIMESTAMP,
+    total NUMERIC,
+    shipping_address TEXT,
+    delivery_type TEXT,
+    notes TEXT,
+    shipping_cost NUMERIC,
+    coupon_discount_amount NUMERIC,
+    username TEXT,
+    email TEXT,
+    fullname TEXT,
+    phone TEXT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_sale RECORD;
+    v_confirmed_at TIMESTAMP;
+BEGIN
+    SELECT
+        s.status,
+        s.reservation_expires_at,
+        s.storage_id,
+        s.web_user_id,
+        s.total::NUMERIC AS total,
+        s.shipping_address::TEXT AS shipping_address,
+        s.delivery_type::TEXT AS delivery_type,
+        s.notes::TEXT AS notes,
+        s.shipping_cost::NUMERIC AS shipping_cost,
+        s.coupon_discount_amount::NUMERIC AS coupon_discount_amount,
+        COALESCE(wu.username, 'Invitado')::TEXT AS username,
+        wu.email::TEXT AS email,
+        wu.fullname::TEXT AS fullname,
+        wu.phone::TEXT AS phone
+    INTO v_sale
+    FROM sales s
+    LEFT JOIN web_users wu ON wu.id = s.web_user_id
+    WHERE s.id = p_sale_id
+    FOR UPDATE OF s;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, NULL::TEXT, NULL::INTEGER, NULL::TIMESTAMP,
+            NULL::NUMERIC, NULL::TEXT, NULL::TEXT, NULL::TEXT, NULL::NUMERIC, NULL::NUMERIC,
+            NULL::TEXT, NULL::TEXT, NULL::TEXT, NULL::TEXT;
+        RETURN;
+    END IF;
+
+    IF v_sale.status <> 'Pendiente' THEN
+        RETURN QUERY SELECT 'not_pending'::TEXT, v_sale.status::TEXT, v_sale.web_user_id, NULL::TIMESTAMP,
+            v_sale.total, v_sale.shipping_address, v_sale.delivery_type, v_sale.notes,
+            v_sale.shipping_cost, v_sale.coupon_discount_amount,
+            v_sale.username, v_sale.email, v_sale.fullname, v_sale.phone;
+        RETURN;
+    END IF;
+
+    -- reservation_expires_at is stored as naive UTC
+    IF v_sale.reservation_expires_at IS NOT NULL
+       AND (now() AT TIME ZONE 'UTC') > v_sale.reservation_expires_at THEN
+        UPDATE sales SET status = 'Cancelada', updated_at = CURRENT_TIMESTAMP WHERE id = p_sale_id;
+        UPDATE stock_reservations SET status = 'expired' WHERE sale_id = p_sale_id;
+        RETURN QUERY SELECT 'expired'::TEXT, 'Cancelada'::TEXT, v_sale.web_user_id, NULL::TIMESTAMP,
+            v_sale.total, v_sale.shipping_address, v_sale.delivery_type, v_sale.notes,
+            v_sale.shipping_cost, v_sale.coupon_discount_amount,
+            v_sale.username, v_sale.email, v_sale.fullname, v_sale.phone;
+        RETURN;
+    END IF;
+
+    IF NOT EXISTS (
+        SELECT 1 FROM stock_reservations sr
+        WHERE sr.sale_id = p_sale_id AND sr.status = 'active'
+    ) THEN
+        RETURN QUERY SELECT 'no_reservations'::TEXT, v_sale.status::TEXT, v_sale.web_user_id, NULL::TIMESTAMP,
+            v_sale.total, v_sale.shipping_address, v_sale.delivery_type, v_sale.notes,
+            v_sale.shipping_cost, v_sale.coupon_discount_amount,
+            v_sale.username, v_sale.email, v_sale.fullname, v_sale.phone;
+        RETURN;
+    END IF;
+
+    -- Allocate each reserved variant across its branch assignments (sale's
+    -- branch first, then largest assignment), deduct the same quantities from
+    -- the physical stock, lower displayed_stock and confirm the reservations
+    WITH need AS (
+        SELECT sr.variant_id, SUM(sr.quantity) AS quantity
+        FROM stock_reservations sr
+        WHERE sr.sale_id = p_sale_id AND sr.status = 'active'
+        GROUP BY sr.variant_id
+    ),
+    alloc AS (
+        SELECT
+            wvba.id,
+            LEAST(
+                wvba.cantidad_asignada,
+                GREATEST(0, need.quantity - COALESCE(SUM(wvba.cantidad_asignada) OVER (
+                    PARTITION BY wvba.variant_id
+                    ORDER BY
+                        CASE WHEN wvba.branch_id = COALESCE(v_sale.storage_id, 0) THEN 0 ELSE 1 END,
+                        wvba.cantidad_asignada DESC,
+                        wvba.id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ), 0))
+            ) AS take
+        FROM web_variant_branch_assignment wvba
+        JOIN need ON need.variant_id = wvba.variant_id
+        WHERE wvba.cantidad_asignada > 0
+    ),
+    deducted AS (
+        UPDATE web_variant_branch_assignment wvba
+        SET cantidad_asignada = wvba.cantidad_asignada - alloc.take,
+            updated_at = CURRENT_TIMESTAMP
+        FROM alloc
+        WHERE wvba.id = alloc.id AND alloc.take > 0
+        RETURNING wvba.id, wvba.variant_id, wvba.branch_id, alloc.take
+    ),
+    physical AS (
+        UPDATE warehouse_stock_variants wsv
+        SET quantity = wsv.quantity - matched.take,
+            last_updated = CURRENT_TIMESTAMP
+        FROM (
+            SELECT DISTINCT ON (deducted.id) w.id AS warehouse_variant_id, deducted.take
+            FROM deducted
+            JOIN web_variants wv ON wv.id = deducted.variant_id
+            JOIN warehouse_stock_variants w ON w.product_id = wv.product_id
+                AND w.size_id = wv.size_id
+                AND w.color_id = wv.color_id
+                AND w.branch_id = deducted.branch_id
+            ORDER BY deducted.id, w.id
+        ) matched
+        WHERE wsv.id = matched.warehouse_variant_id
+    ),
+    displayed AS (
+        UPDATE web_variants wv
+        SET displayed_stock = GREATEST(wv.displayed_stock - taken.quantity, 0)
+        FROM (
+            SELECT deducted.variant_id, SUM(deducted.take) AS quantity
+            FROM deducted
+            GROUP BY deducted.variant_id
+        ) taken
+        WHERE wv.id = taken.variant_id
+    )
+    UPDATE stock_reservations sr
+    SET status = 'confirmed'
+    WHERE sr.sale_id = p_sale_id AND sr.status = 'active';
+
+    -- Clear the buyer's cart
+    DELETE FROM web_cart_items wci
+    WHERE wci.cart_id IN (SELECT wc.id FROM web_carts wc WHERE wc.user_id = v_sale.web_user_id);
+
+    UPDATE sales
+    SET status = 'Completada',
+        shipping_status = 'preparando',
+        payment_reference = p_payment_reference,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_sale_id;
+
+    INSERT INTO sales_tracking_history (
+        sale_id,
+        status,
+        description,
+        location,
+        changed_by_user_id,
+        created_at
+    )
+    VALUES (p_sale_id, 'preparando', p_description, 'Sistema Web', NULL, CURRENT_TIMESTAMP)
+    RETURNING sales_tracking_history.created_at INTO v_confirmed_at;
+
+    RETURN QUERY SELECT 'confirmed'::TEXT, 'Completada'::TEXT, v_sale.web_user_id, v_confirmed_at,
+            v_sale.total, v_sale.shipping_address, v_sale.delivery_type, v_sale.notes,
+            v_sale.shipping_cost, v_sale.coupon_discount_amount,
+            v_sale.username, v_sale.email, v_sale.fullname, v_sale.phone;
+END;
+$$;
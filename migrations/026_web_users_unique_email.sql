@@ -0,0 +1,6 @@
+-- Migration 026: Enforce unique emails on web_users
+-- register / PUT /auth/me / admin user updates rely on the unique violation
+-- instead of a racy SELECT pre-check. username and cuit are already UNIQUE (001).
+-- Resolve any duplicated emails before running this migration.
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_web_users_email ON web_users (email);
@@ -0,0 +1,10 @@
+-- Migration 027: Index the web_users token lookups
+-- Every authenticated request resolves its user by session_token, and
+-- /auth/verify-email by verification_token; both are equality-only lookups.
+-- Hash indexes keep one small hash per row instead of the whole token text.
+
+CREATE INDEX IF NOT EXISTS idx_web_users_session_token
+    ON web_users USING hash (session_token);
+
+CREATE INDEX IF NOT EXISTS idx_web_users_verification_token
+    ON web_users USING hash (verification_token);
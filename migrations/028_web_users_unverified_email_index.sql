@@ -0,0 +1,7 @@
+-- Migration 028: Partial index for /auth/resend-verification
+-- The endpoint only acts on accounts that are still unverified, a small slice
+-- of web_users; indexing just those rows keeps the index tiny and cached.
+
+CREATE INDEX IF NOT EXISTS idx_web_users_unverified_email
+    ON web_users (email)
+    WHERE email_verified = FALSE;
@@ -0,0 +1,19 @@
+-- Migration 029: Pre-aggregated waiting list stats
+-- GET /waiting_list/stats reads this view instead of grouping lista_espera
+-- on every dashboard load. It is refreshed periodically by the API
+-- (utils/tasks.refresh_waiting_list_stats), so counts may lag a few minutes.
+-- The unique index is required by REFRESH MATERIALIZED VIEW CONCURRENTLY.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_waiting_list_stats AS
+SELECT
+    producto_buscado,
+    COUNT(*) AS count
+FROM lista_espera
+GROUP BY producto_buscado
+WITH DATA;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_mv_waiting_list_stats_producto
+    ON mv_waiting_list_stats (producto_buscado);
+
+CREATE INDEX IF NOT EXISTS idx_mv_waiting_list_stats_count
+    ON mv_waiting_list_stats (count DESC);
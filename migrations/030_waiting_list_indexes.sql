@@ -0,0 +1,12 @@
+-- Migration 030: Indexes for GET /waiting_list
+-- Note: lista_espera_talles / lista_espera_colores lookups by waiting_list_id are
+-- already covered by their UNIQUE(waiting_list_id, size_id / color_id) constraints (014).
+
+-- producto filter: producto_buscado ILIKE '%...%' (trigram index, usable for infix matches)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_lista_espera_producto_trgm
+    ON lista_espera USING gin (producto_buscado gin_trgm_ops);
+
+-- Listing order: ORDER BY created_at DESC
+CREATE INDEX IF NOT EXISTS idx_lista_espera_created_at ON lista_espera (created_at DESC);
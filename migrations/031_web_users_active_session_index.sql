@@ -0,0 +1,12 @@
+-- Migration 031: Partial unique index for the active-session lookup
+-- utils/auth.py, routes/user.py and routes/purchases.py resolve the user with
+-- WHERE session_token = $1 AND status = 'active'. Indexing only active rows
+-- bakes the status filter into the index (no recheck per matched row) and
+-- keeps it smaller than the full-table one. Tokens are random, so uniqueness
+-- holds; NULL tokens (logged out) never conflict.
+-- idx_web_users_session_token (027) stays for the lookups without the status
+-- filter (logout, admin role checks).
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_web_users_active_session_token
+    ON web_users (session_token)
+    WHERE status = 'active';
@@ -0,0 +1,6 @@
+-- Migration 032: stock_reservations.reserved_at on the same clock as expires_at
+-- Reservation timestamps are stored as naive UTC; CURRENT_TIMESTAMP would
+-- record the server's local time instead.
+
+ALTER TABLE stock_reservations
+    ALTER COLUMN reserved_at SET DEFAULT (now() AT TIME ZONE 'UTC');
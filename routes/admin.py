@@ -17,8 +17,10 @@ from models.order_models import (
     OrderItem,
     TrackingHistoryItem
 )
-from utils.auth import require_admin
+from utils.auth import require_admin, invalidate_token
 from utils.email import send_ready_for_pickup_email
+from utils.cache import purchase_history_cache
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -145,12 +147,14 @@ async def update_user_role(user_id: int, role_data: UpdateUserRole, authorizatio
                     detail="No puedes quitarte el rol de admin a ti mismo"
                 )
         
-        # Update role
-        await db.execute(
-            "UPDATE web_users SET role = $1 WHERE id = $2",
+        # Update role, dropping the user's cached session so the new role
+        # applies on their next request
+        session_token = await db.fetch_val(
+            "UPDATE web_users SET role = $1 WHERE id = $2 RETURNING session_token",
             role_data.role,
             user_id
         )
+        invalidate_token(session_token)
         
         return {"message": f"Rol actualizado a '{role_data.role}' exitosamente", "user_id": user_id, "new_role": role_data.role}
         
@@ -193,12 +197,13 @@ async def update_user_status(user_id: int, status_data: UpdateUserStatus):
                 detail=f"Usuario con ID {user_id} no encontrado"
             )
         
-        # Update status
-        await db.execute(
-            "UPDATE web_users SET status = $1 WHERE id = $2",
+        # Update status; a deactivated user must stop resolving from the cache
+        session_token = await db.fetch_val(
+            "UPDATE web_users SET status = $1 WHERE id = $2 RETURNING session_token",
             status_data.status,
             user_id
         )
+        invalidate_token(session_token)
         
         return {"message": f"Estado actualizado a '{status_data.status}' exitosamente", "user_id": user_id, "new_status": status_data.status}
         
@@ -532,6 +537,7 @@ async def update_order_status(order_id: int, status_data: UpdateOrderStatus):
             """
             SELECT 
                 s.id,
+                s.web_user_id,
                 s.storage_id,
                 s.delivery_type,
                 wu.email,
@@ -576,6 +582,7 @@ async def update_order_status(order_id: int, status_data: UpdateOrderStatus):
             status_data.status,
             description
         )
+        purchase_history_cache.pop(order['web_user_id'])
         
         # Send email if status is 'lista_para_retirar'
         if status_data.status == 'lista_para_retirar' and order['email']:
@@ -622,6 +629,18 @@ async def update_order_status(order_id: int, status_data: UpdateOrderStatus):
 
 # --- DASHBOARD STATISTICS ---
 
+@router.get("/pool/stats", dependencies=[Depends(require_admin)])
+async def get_pool_stats():
+    """
+    Get database connection pool usage (admin only).
+    
+    Returns pool size limits plus current, idle and in-use connections.
+    
+    Requires: Admin authentication
+    """
+    return db.pool_stats()
+
+
 @router.get("/stats", dependencies=[Depends(require_admin)])
 async def get_dashboard_stats():
     """
@@ -636,38 +655,59 @@ async def get_dashboard_stats():
     Requires: Admin authentication
     """
     try:
-        # User statistics
-        total_users = await db.fetch_val("SELECT COUNT(*) FROM web_users")
-        total_customers = await db.fetch_val("SELECT COUNT(*) FROM web_users WHERE role = 'customer'")
-        total_admins = await db.fetch_val("SELECT COUNT(*) FROM web_users WHERE role = 'admin'")
-        
-        # Product statistics
-        total_products = await db.fetch_val("SELECT COUNT(*) FROM products")
-        products_online = await db.fetch_val("SELECT COUNT(*) FROM products WHERE en_tienda_online = TRUE")
-        
-        # Order statistics
-        total_orders = await db.fetch_val("SELECT COUNT(*) FROM sales WHERE origin = 'web'")
-        orders_pending = await db.fetch_val(
-            "SELECT COUNT(*) FROM sales WHERE status = 'Completada' AND shipping_status = 'pendiente' AND origin = 'web'"
-        )
-        
-        # Orders this month
-        orders_this_month = await db.fetch_val(
-            """
-            SELECT COUNT(*) FROM sales 
-            WHERE DATE_TRUNC('month', sale_date) = DATE_TRUNC('month', CURRENT_DATE) AND origin = 'web'
-            """
-        )
-        
-        # Revenue statistics
-        revenue_this_month = await db.fetch_val(
-            """
-            SELECT COALESCE(SUM(total), 0) FROM sales 
-            WHERE DATE_TRUNC('month', sale_date) = DATE_TRUNC('month', CURRENT_DATE) AND origin = 'web'
-            """
+        # One aggregate per table (counts via FILTER), run concurrently on
+        # separate pool connections
+        users, products, orders = await asyncio.gather(
+            # User statistics
+            db.fetch_one(
+                """
+                SELECT 
+                    COUNT(*) as total_users,
+                    COUNT(*) FILTER (WHERE role = 'customer') as total_customers,
+                    COUNT(*) FILTER (WHERE role = 'admin') as total_admins
+                FROM web_users
+                """
+            ),
+            # Product statistics
+            db.fetch_one(
+                """
+                SELECT 
+                    COUNT(*) as total_products,
+                    COUNT(*) FILTER (WHERE en_tienda_online = TRUE) as products_online
+                FROM products
+                """
+            ),
+            # Order and revenue statistics (web orders)
+            db.fetch_one(
+                """
+                SELECT 
+                    COUNT(*) as total_orders,
+                    COUNT(*) FILTER (
+                        WHERE status = 'Completada' AND shipping_status = 'pendiente'
+                    ) as orders_pending,
+                    COUNT(*) FILTER (
+                        WHERE DATE_TRUNC('month', sale_date) = DATE_TRUNC('month', CURRENT_DATE)
+                    ) as orders_this_month,
+                    COALESCE(SUM(total) FILTER (
+                        WHERE DATE_TRUNC('month', sale_date) = DATE_TRUNC('month', CURRENT_DATE)
+                    ), 0) as revenue_this_month,
+                    COALESCE(SUM(total), 0) as revenue_total
+                FROM sales
+                WHERE origin = 'web'
+                """
+            ),
         )
         
-        revenue_total = await db.fetch_val("SELECT COALESCE(SUM(total), 0) FROM sales WHERE origin = 'web'")
+        total_users = users['total_users']
+        total_customers = users['total_customers']
+        total_admins = users['total_admins']
+        total_products = products['total_products']
+        products_online = products['products_online']
+        total_orders = orders['total_orders']
+        orders_pending = orders['orders_pending']
+        orders_this_month = orders['orders_this_month']
+        revenue_this_month = orders['revenue_this_month']
+        revenue_total = orders['revenue_total']
         
         return {
             "total_users": total_users or 0,
@@ -737,47 +777,41 @@ async def create_group_discount(discount_data: CreateGroupDiscount):
             discount_data.apply_to_children
         )
         
-        # Find all products in the group (with recursive query if apply_to_children)
+        # Discount every product of the group (and of its subgroups when
+        # apply_to_children) with one set-based UPDATE
         if discount_data.apply_to_children:
-            # Recursive query to get all child groups
-            products_query = """
+            target_groups = """
                 WITH RECURSIVE group_tree AS (
                     SELECT id FROM groups WHERE id = $1
                     UNION ALL
                     SELECT g.id FROM groups g
                     INNER JOIN group_tree gt ON g.parent_group_id = gt.id
-                )
-                SELECT id, sale_price FROM products 
-                WHERE group_id IN (SELECT id FROM group_tree)
+                ),
             """
+            group_filter = "group_id IN (SELECT id FROM group_tree)"
         else:
-            products_query = "SELECT id, sale_price FROM products WHERE group_id = $1"
+            target_groups = "WITH"
+            group_filter = "group_id = $1"
         
-        products = await db.fetch_all(products_query, discount_data.group_id)
-        
-        # Apply discount to each product
-        affected_count = 0
-        for product in products:
-            discount_amount = float(product['sale_price']) * (discount_data.discount_percentage / 100)
-            new_price = float(product['sale_price']) - discount_amount
-            
-            await db.execute(
-                """
+        affected_count = await db.fetch_val(
+            f"""
+            {target_groups}
+            updated AS (
                 UPDATE products
                 SET has_discount = 1,
-                    discount_percentage = $1,
+                    discount_percentage = $2,
                     original_price = CASE WHEN has_discount = 0 THEN sale_price ELSE original_price END,
-                    discount_amount = $2,
-                    sale_price = $3,
+                    discount_amount = sale_price * $2::numeric / 100,
+                    sale_price = sale_price - sale_price * $2::numeric / 100,
                     last_modified_date = CURRENT_TIMESTAMP
-                WHERE id = $4
-                """,
-                discount_data.discount_percentage,
-                discount_amount,
-                new_price,
-                product['id']
+                WHERE {group_filter}
+                RETURNING 1
             )
-            affected_count += 1
+            SELECT COUNT(*) FROM updated
+            """,
+            discount_data.group_id,
+            discount_data.discount_percentage
+        )
         
         return {
             "message": "Descuento aplicado exitosamente",
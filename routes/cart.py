@@ -221,13 +221,13 @@ async def add_to_cart(item_data: AddToCartRequest, authorization: Optional[str]
             )
         
         # Get or create cart
-        cart = await db.fetch_one(
+        cart_id = await db.fetch_val(
             "SELECT id FROM web_carts WHERE user_id = $1",
             user_id
         )
         
-        if not cart:
-            cart = await db.fetch_one(
+        if not cart_id:
+            cart_id = await db.fetch_val(
                 """
                 INSERT INTO web_carts (user_id, created_at)
                 VALUES ($1, CURRENT_TIMESTAMP)
@@ -243,7 +243,7 @@ async def add_to_cart(item_data: AddToCartRequest, authorization: Optional[str]
             FROM web_cart_items
             WHERE cart_id = $1 AND product_id = $2 AND variant_id = $3
             """,
-            cart['id'],
+            cart_id,
             item_data.product_id,
             item_data.variant_id
         )
@@ -276,7 +276,7 @@ async def add_to_cart(item_data: AddToCartRequest, authorization: Optional[str]
                 VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP)
                 RETURNING id, product_id, variant_id, quantity
                 """,
-                cart['id'],
+                cart_id,
                 item_data.product_id,
                 item_data.variant_id,
                 item_data.quantity
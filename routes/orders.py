@@ -7,6 +7,7 @@ from typing import Optional
 from config.db_connection import db
 from models.cart_models import CheckoutRequest
 from utils.auth import get_current_web_user
+from utils.cache import purchase_history_cache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -39,12 +40,12 @@ async def checkout(checkout_data: CheckoutRequest, authorization: Optional[str]
         user_id = user['id']
         
         # Get user's cart
-        cart = await db.fetch_one(
+        cart_id = await db.fetch_val(
             "SELECT id FROM web_carts WHERE user_id = $1",
             user_id
         )
         
-        if not cart:
+        if not cart_id:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="No tienes un carrito activo"
@@ -92,7 +93,7 @@ async def checkout(checkout_data: CheckoutRequest, authorization: Optional[str]
             LEFT JOIN colors c_warehouse ON wsv.color_id = c_warehouse.id
             WHERE wci.cart_id = $1
             """,
-            cart['id']
+            cart_id
         )
         
         if not cart_items:
@@ -149,6 +150,7 @@ async def checkout(checkout_data: CheckoutRequest, authorization: Optional[str]
         )
         
         # Create sales_detail records
+        planned_deductions = {}  # web_variant_branch_assignment id -> quantity
         for item in cart_items:
             await db.execute(
                 """
@@ -219,25 +221,33 @@ async def checkout(checkout_data: CheckoutRequest, authorization: Optional[str]
                     if remaining_to_deduct <= 0:
                         break
                     
-                    deduct_amount = min(assignment['cantidad_asignada'], remaining_to_deduct)
-                    
-                    await db.execute(
-                        """
-                        UPDATE web_variant_branch_assignment
-                        SET cantidad_asignada = cantidad_asignada - $1,
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE id = $2
-                        """,
-                        deduct_amount,
-                        assignment['id']
-                    )
+                    # Discount what earlier cart items already planned on this row
+                    available = assignment['cantidad_asignada'] - planned_deductions.get(assignment['id'], 0)
+                    deduct_amount = min(available, remaining_to_deduct)
+                    if deduct_amount <= 0:
+                        continue
                     
+                    planned_deductions[assignment['id']] = planned_deductions.get(assignment['id'], 0) + deduct_amount
                     remaining_to_deduct -= deduct_amount
         
+        # Apply all planned web stock deductions in one statement
+        if planned_deductions:
+            await db.execute(
+                """
+                UPDATE web_variant_branch_assignment wvba
+                SET cantidad_asignada = wvba.cantidad_asignada - d.delta,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM unnest($1::int[], $2::int[]) AS d(id, delta)
+                WHERE wvba.id = d.id
+                """,
+                list(planned_deductions.keys()),
+                list(planned_deductions.values())
+            )
+        
         # Clear cart
         await db.execute(
             "DELETE FROM web_cart_items WHERE cart_id = $1",
-            cart['id']
+            cart_id
         )
         
         # Create tracking history
@@ -248,6 +258,7 @@ async def checkout(checkout_data: CheckoutRequest, authorization: Optional[str]
             """,
             sale['id']
         )
+        purchase_history_cache.pop(user_id)
         
         return {
             "message": "Orden creada exitosamente",
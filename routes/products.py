@@ -1349,17 +1349,8 @@ async def get_all_productos(
 
             products = await db.fetch_all(query_products, limit, skip, branch_id)
 
-        # Parse JSON strings to objects
-        parsed_products = []
-        for p in products:
-            p_dict = dict(p)
-            if isinstance(p_dict.get("variantes"), str):
-                import json
-
-                p_dict["variantes"] = json.loads(p_dict["variantes"])
-            parsed_products.append(p_dict)
-
-        return parsed_products
+        # variantes already arrives as a list (pool JSON codec)
+        return products
     except Exception as e:
         # logger.error(f"Error fetching productos: {e}")
         # Asegúrate de importar logger si lo usas
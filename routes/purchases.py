@@ -3,14 +3,18 @@ Purchase/Sales routes for web users.
 Handles retrieving purchase history for authenticated users.
 """
 
-from fastapi import APIRouter, HTTPException, Header, status
+from fastapi import APIRouter, HTTPException, Header, Response, status
 from typing import Optional, List
-from datetime import datetime
 import os
 
-from config.db_connection import DatabaseManager
+from config.db_connection import DatabaseManager, PoolBusyError
 from models.cart_models import CreateOrderRequest, TrackingUpdateRequest, PaymentConfirmationRequest, CancelOrderRequest
 from utils.email import send_new_order_notification_to_business, send_order_status_email
+from utils.order_service import confirm_sale_payment, set_order_tx_timeouts
+from utils.email_tasks import enqueue_email
+from utils.cache import purchase_history_cache
+from utils.auth import get_current_user
+from utils.responses import dumps, pool_busy_exception
 
 router = APIRouter()
 
@@ -18,6 +22,201 @@ router = APIRouter()
 FRONTEND_URL = os.getenv("FRONTEND_URL", "https://mykonosboutique.com.ar")
 RESERVATION_MINUTES = 30
 
+# Tracking descriptions for each cancellation reason
+_REASON_TEXT = {
+    'expired': 'Pedido cancelado automáticamente por expiración de reserva',
+    'user_cancelled': 'Pedido cancelado por el cliente',
+    'payment_failed': 'Pedido cancelado por fallo en el pago'
+}
+
+# Hot SQL, kept as module constants so every call reuses the same
+# prepared statement (see DatabaseManager.register_hot_statements)
+SQL_SALES_BY_USER = """
+SELECT 
+    s.id,
+    s.sale_date,
+    s.subtotal,
+    s.tax_amount,
+    s.discount,
+    s.total,
+    s.status,
+    s.shipping_address,
+    s.shipping_status,
+    s.shipping_cost,
+    s.payment_reference,
+    s.invoice_number,
+    s.notes,
+    s.origin,
+    s.coupon_id,
+    s.coupon_code,
+    s.coupon_discount_type,
+    s.coupon_discount_value,
+    s.coupon_discount_amount,
+    s.original_total
+FROM sales s
+WHERE s.web_user_id = $1 AND s.origin = 'web'
+ORDER BY s.sale_date DESC
+"""
+
+SQL_DETAILS_BY_SALES = """
+SELECT 
+    sd.sale_id,
+    sd.id,
+    sd.product_name,
+    sd.product_code,
+    sd.size_name,
+    sd.color_name,
+    sd.sale_price,
+    sd.quantity,
+    sd.discount_percentage,
+    sd.discount_amount,
+    sd.subtotal,
+    sd.total,
+    p.id as product_id
+FROM sales_detail sd
+LEFT JOIN products p ON sd.product_id = p.id
+WHERE sd.sale_id = ANY($1::int[])
+ORDER BY sd.sale_id, sd.id
+"""
+
+SQL_FIRST_IMAGES = """
+SELECT DISTINCT ON (product_id) product_id, image_url
+FROM images
+WHERE product_id = ANY($1::int[])
+ORDER BY product_id, orden ASC
+"""
+
+SQL_INSERT_SALE = """
+INSERT INTO sales (
+    web_user_id,
+    employee_id,
+    cashier_user_id,
+    storage_id,
+    sale_date,
+    subtotal,
+    tax_amount,
+    discount,
+    total,
+    status,
+    origin,
+    shipping_address,
+    shipping_status,
+    shipping_cost,
+    delivery_type,
+    notes,
+    reservation_expires_at,
+    payment_method,
+    coupon_id,
+    coupon_code,
+    coupon_discount_type,
+    coupon_discount_value,
+    coupon_discount_amount,
+    original_total,
+    created_at,
+    updated_at
+)
+VALUES ($1, 1, 1, $2, CURRENT_TIMESTAMP, $3, 0, $14, $4, $5, $6, $7, $8, $9, $10, $11, (now() AT TIME ZONE 'UTC') + make_interval(mins => $12), $13, $15, $16, $17, $18, $19, $20, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+RETURNING id, sale_date, subtotal, total, status, shipping_status, reservation_expires_at
+"""
+
+# Every sale detail and stock reservation of a new order, plus its initial
+# tracking entry, in one statement; the per-item columns travel as arrays
+# ($2..$12, one element per cart item, $13 the web variant reserved)
+SQL_INSERT_ORDER_ITEMS = """
+WITH details AS (
+    INSERT INTO sales_detail (
+        sale_id,
+        product_id,
+        variant_id,
+        product_name,
+        product_code,
+        size_name,
+        color_name,
+        cost_price,
+        sale_price,
+        quantity,
+        discount_percentage,
+        discount_amount,
+        tax_percentage,
+        tax_amount,
+        subtotal,
+        total,
+        created_at
+    )
+    SELECT $1, d.product_id, d.variant_id, d.product_name, d.product_code, d.size_name, d.color_name,
+           0, d.unit_price, SUM(d.quantity), d.discount_percentage, d.discount_amount, 0, 0,
+           SUM(d.subtotal), SUM(d.subtotal), CURRENT_TIMESTAMP
+    FROM unnest(
+        $2::int[], $3::int[], $4::text[], $5::text[], $6::text[], $7::text[],
+        $8::numeric[], $9::int[], $10::numeric[], $11::numeric[], $12::numeric[], $13::int[]
+    ) WITH ORDINALITY AS d(product_id, variant_id, product_name, product_code, size_name, color_name,
+           unit_price, quantity, discount_percentage, discount_amount, subtotal, web_variant_id, n)
+    -- Repeated cart lines of the same web variant become a single detail row
+    -- (keyed on the web variant: the warehouse variant id may be NULL)
+    GROUP BY d.web_variant_id, d.product_id, d.variant_id, d.product_name, d.product_code,
+             d.size_name, d.color_name, d.unit_price, d.discount_percentage, d.discount_amount
+    ORDER BY MIN(d.n)
+),
+reservations AS (
+    INSERT INTO stock_reservations (
+        sale_id,
+        variant_id,
+        quantity,
+        reserved_at,
+        expires_at,
+        status
+    )
+    SELECT $1, r.variant_id, r.quantity, (now() AT TIME ZONE 'UTC'), $14, 'active'
+    FROM unnest($13::int[], $9::int[]) AS r(variant_id, quantity)
+)
+INSERT INTO sales_tracking_history (
+    sale_id,
+    status,
+    description,
+    location,
+    changed_by_user_id,
+    created_at
+)
+VALUES ($1, 'pendiente', 'Pedido creado. Esperando confirmación de pago.', 'Sistema Web', NULL, CURRENT_TIMESTAMP)
+"""
+
+# Cancel a sale, release its reservations and log the tracking entry in one
+# statement; every row gets the same transaction timestamp (CURRENT_TIMESTAMP)
+SQL_CANCEL_ORDER = """
+WITH cancelled AS (
+    UPDATE sales
+    SET status = 'Cancelada',
+        shipping_status = 'cancelado',
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = $1
+),
+released AS (
+    UPDATE stock_reservations
+    SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+    WHERE sale_id = $1 AND status = 'active'
+)
+INSERT INTO sales_tracking_history (
+    sale_id,
+    status,
+    description,
+    location,
+    changed_by_user_id,
+    created_at
+)
+VALUES ($1, 'cancelado', $2, 'Sistema Web', NULL, CURRENT_TIMESTAMP)
+RETURNING created_at
+"""
+
+DatabaseManager.register_hot_statements(
+    SQL_SALES_BY_USER,
+    SQL_DETAILS_BY_SALES,
+    SQL_FIRST_IMAGES,
+    SQL_INSERT_SALE,
+    SQL_INSERT_ORDER_ITEMS,
+    SQL_CANCEL_ORDER,
+)
+
+
 async def get_shipping_config(conn) -> dict:
     """Obtiene la política de envío activa de la BD."""
     row = await conn.fetchrow("SELECT * FROM shipping_config WHERE id = 1")
@@ -47,26 +246,6 @@ def calculate_shipping_cost(api_cost: float, subtotal: float, config: dict) -> f
         return 0.0 if float(subtotal) >= float(config["free_threshold"]) else float(api_cost)
 
 
-async def get_user_by_token(token: str):
-    """Get user by session token."""
-    pool = await DatabaseManager.get_pool()
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow(
-            """
-            SELECT id, username, email
-            FROM web_users
-            WHERE session_token = $1 AND status = 'active'
-            """,
-            token
-        )
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid or expired token"
-            )
-        return dict(user)
-
-
 @router.get("/my-purchases")
 async def get_my_purchases(authorization: Optional[str] = Header(None)):
     """
@@ -79,107 +258,53 @@ async def get_my_purchases(authorization: Optional[str] = Header(None)):
     
     Requires Authorization header with Bearer token.
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    current_user = await get_user_by_token(token)
+    current_user = await get_current_user(authorization)
     
-    pool = await DatabaseManager.get_pool()
+    # Serve the already-serialized history if it is still cached
+    cached = purchase_history_cache.get(current_user['id'])
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
     
-    async with pool.acquire() as conn:
+    async with DatabaseManager.acquire() as conn:
         # Get all sales for this web user
         sales = await conn.fetch(
-            """
-            SELECT 
-                s.id,
-                s.sale_date,
-                s.subtotal,
-                s.tax_amount,
-                s.discount,
-                s.total,
-                s.status,
-                s.shipping_address,
-                s.shipping_status,
-                s.shipping_cost,
-                s.payment_reference,
-                s.invoice_number,
-                s.notes,
-                s.origin,
-                s.coupon_id,
-                s.coupon_code,
-                s.coupon_discount_type,
-                s.coupon_discount_value,
-                s.coupon_discount_amount,
-                s.original_total
-            FROM sales s
-            WHERE s.web_user_id = $1 AND s.origin = 'web'
-            ORDER BY s.sale_date DESC
-            """,
+            SQL_SALES_BY_USER,
             current_user['id']
         )
         
         if not sales:
+            purchase_history_cache.set(current_user['id'], b"[]")
             return []
         
-        # For each sale, get the details (products)
-        purchases = []
-        for sale in sales:
-            sale_dict = dict(sale)
-            
-            # Get sale details (products)
-            details = await conn.fetch(
-                """
-                SELECT 
-                    sd.id,
-                    sd.product_name,
-                    sd.product_code,
-                    sd.size_name,
-                    sd.color_name,
-                    sd.sale_price,
-                    sd.quantity,
-                    sd.discount_percentage,
-                    sd.discount_amount,
-                    sd.subtotal,
-                    sd.total,
-                    p.id as product_id
-                FROM sales_detail sd
-                LEFT JOIN products p ON sd.product_id = p.id
-                WHERE sd.sale_id = $1
-                """,
-                sale_dict['id']
-            )
-            
-            # Get product images for each item
-            items = []
-            for detail in details:
-                detail_dict = dict(detail)
-                
-                # Get first image of the product
-                if detail_dict['product_id']:
-                    image = await conn.fetchrow(
-                        """
-                        SELECT image_url
-                        FROM images
-                        WHERE product_id = $1
-                        ORDER BY orden ASC
-                        LIMIT 1
-                        """,
-                        detail_dict['product_id']
-                    )
-                    detail_dict['image_url'] = image['image_url'] if image else None
-                else:
-                    detail_dict['image_url'] = None
-                
-                items.append(detail_dict)
-            
-            sale_dict['items'] = items
-            purchases.append(sale_dict)
+        # Get the details (products) of all sales in one query
+        details = await conn.fetch(
+            SQL_DETAILS_BY_SALES,
+            [sale['id'] for sale in sales]
+        )
+        
+        # Get the first image of every product involved, in one query
+        product_ids = list({d['product_id'] for d in details if d['product_id']})
+        images = await conn.fetch(
+            SQL_FIRST_IMAGES,
+            product_ids
+        ) if product_ids else []
+        image_by_product = {img['product_id']: img['image_url'] for img in images}
         
-        return purchases
+        # Group items per sale; each output dict is built once from its record
+        items_by_sale = {}
+        for detail in details:
+            item = dict(detail, image_url=image_by_product.get(detail['product_id']))
+            del item['sale_id']
+            items_by_sale.setdefault(detail['sale_id'], []).append(item)
+        
+        purchases = [
+            dict(sale, items=items_by_sale.get(sale['id'], []))
+            for sale in sales
+        ]
+        
+        body = dumps(purchases)
+        purchase_history_cache.set(current_user['id'], body)
+        return Response(content=body, media_type="application/json")
 
 
 @router.get("/my-purchases/{purchase_id}")
@@ -196,18 +321,9 @@ async def get_purchase_detail(
     
     Requires Authorization header with Bearer token.
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    current_user = await get_user_by_token(token)
+    current_user = await get_current_user(authorization)
     
-    pool = await DatabaseManager.get_pool()
-    
-    async with pool.acquire() as conn:
+    async with DatabaseManager.acquire() as conn:
         # Get sale information and verify it belongs to the user
         sale = await conn.fetchrow(
             """
@@ -322,6 +438,9 @@ async def create_order(
     except HTTPException:
         # Re-raise standard HTTP exceptions (400, 401, etc.) unmodified
         raise
+    except PoolBusyError:
+        # No free pool connection: retryable, not a server error
+        raise pool_busy_exception()
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -357,25 +476,13 @@ async def _create_order_impl(
     
     Requires Authorization header with Bearer token.
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    current_user = await get_user_by_token(token)
+    current_user = await get_current_user(authorization)
     
-    pool = await DatabaseManager.get_pool()
-    
-    # Reservation expiration time (30 minutes)
-    RESERVATION_MINUTES = 30
-    
-    async with pool.acquire() as conn:
+    async with DatabaseManager.acquire() as conn:
         # Start transaction
         async with conn.transaction():
             # Get user's cart
-            cart = await conn.fetchrow(
+            cart_id = await conn.fetchval(
                 "SELECT id FROM web_carts WHERE user_id = $1",
                 current_user['id']
             )
@@ -388,7 +495,7 @@ async def _create_order_impl(
                     current_user['id']
                 )
             
-            if not cart:
+            if not cart_id:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="El carrito está vacío. Agrega productos antes de crear un pedido."
@@ -424,6 +531,14 @@ async def _create_order_impl(
                     END as unit_price,
                     p.precio_web as original_price,
                     CASE WHEN p.has_discount = 1 THEN p.discount_percentage ELSE 0 END as discount_percentage,
+                    -- Cart subtotal computed server-side (same value on every row)
+                    SUM(
+                        CASE 
+                            WHEN p.has_discount = 1 THEN 
+                                 CAST(p.precio_web * (1 - p.discount_percentage / 100.0) AS NUMERIC)
+                            ELSE p.precio_web 
+                        END * wci.quantity
+                    ) OVER () as cart_subtotal,
                     p.provider_code as product_code,
                     COALESCE(s_web.size_name, s_warehouse.size_name) as size_name,
                     COALESCE(c_web.color_name, c_warehouse.color_name) as color_name,
@@ -450,7 +565,7 @@ async def _create_order_impl(
                         FROM stock_reservations sr
                         WHERE sr.variant_id = wci.variant_id 
                         AND sr.status = 'active'
-                        AND sr.expires_at > CURRENT_TIMESTAMP
+                        AND sr.expires_at > (now() AT TIME ZONE 'UTC')  -- naive UTC, like expires_at
                     ), 0) as stock_reserved
                 FROM web_cart_items wci
                 INNER JOIN products p ON wci.product_id = p.id
@@ -472,7 +587,7 @@ async def _create_order_impl(
                 WHERE wci.cart_id = $1
                 ORDER BY wci.id, wci.created_at
                 """,
-                cart['id']
+                cart_id
             )
             
             if not cart_items:
@@ -493,7 +608,7 @@ async def _create_order_impl(
                     )
             
             # Calculate totals
-            subtotal = sum(float(item['unit_price']) * item['quantity'] for item in cart_items)
+            subtotal = cart_items[0]['cart_subtotal']
             
             # Enforce free shipping for store pickup, else calculate based on policy
             if order_data.delivery_type == 'retiro':
@@ -555,7 +670,7 @@ async def _create_order_impl(
                 coupon_id = coupon_row['id']
                 coupon_code = coupon_row['code']
                 coupon_discount_type = coupon_row['discount_type']
-                coupon_discount_value = float(coupon_row['discount_value'])
+                coupon_discount_value = coupon_row['discount_value']
 
                 # original_total = subtotal + shipping BEFORE coupon
                 original_total = total
@@ -579,13 +694,6 @@ async def _create_order_impl(
                 total = max(0.0, total - coupon_discount_amount)
             # ---------------------------------------------------------------
 
-            # Calculate expiration time
-            reservation_expires_at = await conn.fetchval(
-                f"SELECT CURRENT_TIMESTAMP + INTERVAL '{RESERVATION_MINUTES} minutes'"
-            )
-            if hasattr(reservation_expires_at, 'tzinfo') and reservation_expires_at.tzinfo:
-                reservation_expires_at = reservation_expires_at.replace(tzinfo=None)
-            
             # Construct shipping_address if not provided but split fields are
             shipping_address = order_data.shipping_address
             if not shipping_address:
@@ -604,38 +712,7 @@ async def _create_order_impl(
                     shipping_address = "Dirección no provista" if order_data.delivery_type == 'envio' else "Retiro en sucursal"
 
             sale = await conn.fetchrow(
-                """
-                INSERT INTO sales (
-                    web_user_id,
-                    employee_id,
-                    cashier_user_id,
-                    storage_id,
-                    sale_date,
-                    subtotal,
-                    tax_amount,
-                    discount,
-                    total,
-                    status,
-                    origin,
-                    shipping_address,
-                    shipping_status,
-                    shipping_cost,
-                    delivery_type,
-                    notes,
-                    reservation_expires_at,
-                    payment_method,
-                    coupon_id,
-                    coupon_code,
-                    coupon_discount_type,
-                    coupon_discount_value,
-                    coupon_discount_amount,
-                    original_total,
-                    created_at,
-                    updated_at
-                )
-                VALUES ($1, 1, 1, $2, CURRENT_TIMESTAMP, $3, 0, $14, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $15, $16, $17, $18, $19, $20, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                RETURNING id, sale_date, subtotal, total, status, shipping_status, reservation_expires_at
-                """,
+                SQL_INSERT_SALE,
                 current_user['id'],           # $1  web_user_id
                 order_data.branch_id or 1,    # $2  storage_id
                 subtotal,                      # $3  subtotal
@@ -647,7 +724,7 @@ async def _create_order_impl(
                 final_shipping_cost,           # $9  shipping_cost
                 order_data.delivery_type,      # $10 delivery_type
                 order_data.notes,              # $11 notes
-                reservation_expires_at,        # $12 reservation_expires_at
+                RESERVATION_MINUTES,           # $12 reservation_expires_at (minutes from now, naive UTC)
                 order_data.payment_method,     # $13 payment_method
                 coupon_discount_amount,        # $14 discount (campo general de descuento)
                 coupon_id,                     # $15 coupon_id
@@ -661,71 +738,29 @@ async def _create_order_impl(
             
             sale_id = sale['id']
             
-            # Create sale details and stock reservations for each cart item
-            order_items = []
-            for item in cart_items:
-                # Use resolved warehouse_variant_id. If missing, use None (will insert NULL)
-                warehouse_variant_to_use = item['warehouse_variant_id']
-
-                # Create sale detail
-                sale_detail = await conn.fetchrow(
-                    """
-                    INSERT INTO sales_detail (
-                        sale_id,
-                        product_id,
-                        variant_id,
-                        product_name,
-                        product_code,
-                        size_name,
-                        color_name,
-                        cost_price,
-                        sale_price,
-                        quantity,
-                        discount_percentage,
-                        discount_amount,
-                        tax_percentage,
-                        tax_amount,
-                        subtotal,
-                        total,
-                        created_at
-                    )
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, 0, $8, $9, $10, $11, 0, 0, $12, $12, CURRENT_TIMESTAMP)
-                    RETURNING id
-                    """,
-                    sale_id,
-                    item['product_id'],
-                    warehouse_variant_to_use,
-                    item['product_name'],
-                    item['product_code'],
-                    item['size_name'],
-                    item['color_name'],
-                    item['unit_price'],
-                    item['quantity'],
-                    item['discount_percentage'],
-                    float(item.get('original_price', item['unit_price'])) - float(item['unit_price']),
-                    float(item['unit_price']) * item['quantity']
-                )
-                
-                # Create stock reservation (NOT deducting stock yet)
-                await conn.execute(
-                    """
-                    INSERT INTO stock_reservations (
-                        sale_id,
-                        variant_id,
-                        quantity,
-                        reserved_at,
-                        expires_at,
-                        status
-                    )
-                    VALUES ($1, $2, $3, CURRENT_TIMESTAMP, $4, 'active')
-                    """,
-                    sale_id,
-                    item['variant_id'],
-                    item['quantity'],
-                    reservation_expires_at
-                )
-                
-                order_items.append({
+            # Create sale details, stock reservations (NOT deducting stock yet)
+            # and the initial tracking entry (NO email sent) in one round-trip.
+            # warehouse_variant_id may be None (inserts NULL)
+            await conn.execute(
+                SQL_INSERT_ORDER_ITEMS,
+                sale_id,
+                [item['product_id'] for item in cart_items],
+                [item['warehouse_variant_id'] for item in cart_items],
+                [item['product_name'] for item in cart_items],
+                [item['product_code'] for item in cart_items],
+                [item['size_name'] for item in cart_items],
+                [item['color_name'] for item in cart_items],
+                [item['unit_price'] for item in cart_items],
+                [item['quantity'] for item in cart_items],
+                [item['discount_percentage'] for item in cart_items],
+                [item['original_price'] - item['unit_price'] for item in cart_items],
+                [item['unit_price'] * item['quantity'] for item in cart_items],
+                [item['variant_id'] for item in cart_items],
+                sale['reservation_expires_at']
+            )
+            
+            order_items = [
+                {
                     'product_id': item['product_id'],
                     'product_name': item['product_name'],
                     'product_code': item['product_code'],
@@ -733,34 +768,17 @@ async def _create_order_impl(
                     'color_name': item['color_name'],
                     'variant_barcode': item['variant_barcode'],
                     'quantity': item['quantity'],
-                    'unit_price': float(item['unit_price']),
-                    'subtotal': float(item['unit_price']) * item['quantity']
-                })
-            
-            # Create initial tracking history entry (NO email sent)
-            await conn.execute(
-                """
-                INSERT INTO sales_tracking_history (
-                    sale_id,
-                    status,
-                    description,
-                    location,
-                    changed_by_user_id,
-                    created_at
-                )
-                VALUES ($1, $2, $3, $4, NULL, CURRENT_TIMESTAMP)
-                """,
-                sale_id,
-                'pendiente',
-                'Pedido creado. Esperando confirmación de pago.',
-                'Sistema Web',
-            )
+                    'unit_price': item['unit_price'],
+                    'subtotal': item['unit_price'] * item['quantity']
+                }
+                for item in cart_items
+            ]
             
             # Clear the cart - MOVED TO PAYMENT CONFIRMATION
             # to prevent lost carts on payment failure
             # await conn.execute(
             #     "DELETE FROM web_cart_items WHERE cart_id = $1",
-            #     cart['id']
+            #     cart_id
             # )
 
             # ---------------------------------------------------------------
@@ -797,7 +815,7 @@ async def _create_order_impl(
             # Prepare response
             order_details = {
                 'id': sale_id,
-                'sale_date': sale['sale_date'].isoformat() if hasattr(sale['sale_date'], 'isoformat') else str(sale['sale_date']),
+                'sale_date': sale['sale_date'],
                 'subtotal': float(subtotal),
                 'total': float(total),
                 'shipping_cost': float(final_shipping_cost),
@@ -817,14 +835,19 @@ async def _create_order_impl(
                 } if coupon_id else None,
             }
             
-            return {
+            response = {
                 'message': f'Pedido creado exitosamente. Completa el pago en {minutes_to_pay} minutos.',
                 'order_id': sale_id,
-                'reservation_expires_at': sale['reservation_expires_at'].isoformat() if hasattr(sale['reservation_expires_at'], 'isoformat') else str(sale['reservation_expires_at']),
+                'reservation_expires_at': sale['reservation_expires_at'],
                 'minutes_to_pay': minutes_to_pay,
                 'order_details': order_details,
                 'tracking_link': tracking_link
             }
+        
+        # Invalidate once committed, so a concurrent /my-purchases can't
+        # re-cache the list without this order
+        purchase_history_cache.pop(current_user['id'])
+        return response
 
 
 @router.post("/{order_id}/confirm-payment")
@@ -843,292 +866,114 @@ async def confirm_payment(
     4. Deducts stock from web_variant_branch_assignment
     5. Marks reservations as 'confirmed'
     6. Creates tracking entry
-    7. Sends email notifications (business + customer)
+    7. Queues email notifications (business + customer)
+    
+    Steps 1-6 run server-side in a single confirm_sale_payment() call.
     
     Requires Authorization header with Bearer token.
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    current_user = await get_user_by_token(token)
+    current_user = await get_current_user(authorization)
     
-    pool = await DatabaseManager.get_pool()
-    
-    async with pool.acquire() as conn:
-        async with conn.transaction():
-            # Get order details
-            order = await conn.fetchrow(
-                """
-                SELECT 
-                    s.id,
-                    s.status,
-                    s.reservation_expires_at,
-                    s.total,
-                    s.shipping_address,
-                    s.delivery_type,
-                    s.notes,
-                    s.storage_id,
-                    s.web_user_id,
-                    wu.username,
-                    wu.email,
-                    wu.fullname,
-                    wu.phone,
-                    s.shipping_cost,
-                    s.coupon_discount_amount
-                FROM sales s
-                LEFT JOIN web_users wu ON s.web_user_id = wu.id
-                WHERE s.id = $1
-                """,
-                order_id
-            )
-            
-            if not order:
-                raise HTTPException(
-                    status_code=status.HTTP_404_NOT_FOUND,
-                    detail="Pedido no encontrado"
-                )
-            
-            # ... (validation logic remains same) ...
-            
-            # Validate order is pending
-            if order['status'] != 'Pendiente':
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=f"El pedido ya fue procesado. Estado actual: {order['status']}"
-                )
-            
-            # Check if reservation expired
-            if order['reservation_expires_at']:
-                now = await conn.fetchval("SELECT CURRENT_TIMESTAMP")
-                # Ensure timezone compatibility
-                if order['reservation_expires_at'].tzinfo is None and now.tzinfo is not None:
-                    now = now.replace(tzinfo=None)
-                elif order['reservation_expires_at'].tzinfo is not None and now.tzinfo is None:
-                    # Look up how asyncpg returns it, usually aware. If order is aware, make now aware? 
-                    # Simpler to just strip both or ensure now matches order.
-                     now = now.replace(tzinfo=order['reservation_expires_at'].tzinfo)
-                
-                if now > order['reservation_expires_at']:
-                    # Auto-cancel expired order
-                    await conn.execute(
-                        "UPDATE sales SET status = 'Cancelada', updated_at = CURRENT_TIMESTAMP WHERE id = $1",
-                        order_id
-                    )
-                    await conn.execute(
-                        "UPDATE stock_reservations SET status = 'expired' WHERE sale_id = $1",
-                        order_id
-                    )
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="La reserva del pedido ha expirado. Por favor, crea un nuevo pedido."
-                    )
-            
-            # Get reservations for this order
-            reservations = await conn.fetch(
-                """
-                SELECT 
-                    sr.id,
-                    sr.variant_id,
-                    sr.quantity,
-                    wv.product_id
-                FROM stock_reservations sr
-                JOIN web_variants wv ON sr.variant_id = wv.id
-                WHERE sr.sale_id = $1 AND sr.status = 'active'
-                """,
-                order_id
-            )
-            
-            if not reservations:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="No se encontraron reservas activas para este pedido"
-                )
-            
-            # Deduct stock from web_variant_branch_assignment
-            for reservation in reservations:
-                variant_id = reservation['variant_id']
-                quantity_to_deduct = reservation['quantity']
-                
-                # Get branch assignments for this variant
-                # PRIORITIZE the selected branch (storage_id)
-                assignments = await conn.fetch(
-                    """
-                    SELECT id, branch_id, cantidad_asignada
-                    FROM web_variant_branch_assignment
-                    WHERE variant_id = $1 AND cantidad_asignada > 0
-                    ORDER BY 
-                        CASE WHEN branch_id = $2 THEN 0 ELSE 1 END,
-                        cantidad_asignada DESC
-                    """,
-                    variant_id,
-                    order['storage_id'] or 0
-                )
-                
-                remaining_to_deduct = quantity_to_deduct
-                
-                for assignment in assignments:
-                    if remaining_to_deduct <= 0:
-                        break
-                    
-                    deduct_from_this = min(assignment['cantidad_asignada'], remaining_to_deduct)
-                    
-                    # Update assignment
-                    await conn.execute(
-                        """
-                        UPDATE warehouse_stock_variants
-                        SET quantity = quantity - $1,
-                            last_updated = CURRENT_TIMESTAMP
-                        WHERE id = $2
-                        """,
-                        deduct_from_this,
-                        assignment['id']
-                    )
-                    
-                    remaining_to_deduct -= deduct_from_this
-                
-                # Update displayed_stock in web_variants
-                await conn.execute(
-                    """
-                    UPDATE web_variants
-                    SET displayed_stock = (
-                        SELECT COALESCE(SUM(cantidad_asignada), 0)
-                        FROM web_variant_branch_assignment
-                        WHERE variant_id = $1
-                    )
-                    WHERE id = $1
-                    """,
-                    variant_id
-                )
-                
-                # Mark reservation as confirmed
-                await conn.execute(
-                    """
-                    UPDATE stock_reservations
-                    SET status = 'confirmed'
-                    WHERE id = $1
-                    """,
-                    reservation['id']
-                )
-
-            # Clear the cart for this user (if exists)
-            # We need to find the cart for the user who made the order
-            cart = await conn.fetchrow(
-                "SELECT id FROM web_carts WHERE user_id = $1",
-                order['web_user_id']
-            )
-            
-            if cart:
-                await conn.execute(
-                    "DELETE FROM web_cart_items WHERE cart_id = $1",
-                    cart['id']
-                )
-
-            
-            # Update order status
-            await conn.execute(
-                """
-                UPDATE sales
-                SET status = 'Completada',
-                    shipping_status = 'preparando',
-                    payment_reference = $1,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = $2
-                """,
-                payment_data.payment_reference,
-                order_id
+    async with DatabaseManager.acquire() as conn:
+        result = await confirm_sale_payment(
+            conn,
+            order_id,
+            payment_data.payment_reference,
+            f'Pago confirmado. Pedido en preparación. Método: {payment_data.payment_method}'
+        )
+        outcome = result['outcome']
+        
+        if outcome == 'not_found':
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Pedido no encontrado"
             )
-            
-            # Create tracking entry
-            await conn.execute(
-                """
-                INSERT INTO sales_tracking_history (
-                    sale_id,
-                    status,
-                    description,
-                    location,
-                    changed_by_user_id,
-                    created_at
-                )
-                VALUES ($1, $2, $3, $4, NULL, CURRENT_TIMESTAMP)
-                """,
-                order_id,
-                'preparando',
-                f'Pago confirmado. Pedido en preparación. Método: {payment_data.payment_method}',
-                'Sistema Web'
+        
+        if outcome == 'not_pending':
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"El pedido ya fue procesado. Estado actual: {result['sale_status']}"
             )
-            
-            # Get order items count for email
-            items_count = await conn.fetchval(
-                "SELECT COUNT(*) FROM sales_detail WHERE sale_id = $1",
-                order_id
+        
+        # Expired orders are auto-cancelled by confirm_sale_payment()
+        if outcome == 'expired':
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="La reserva del pedido ha expirado. Por favor, crea un nuevo pedido."
             )
-            
-            # Fetch items to show in the email
-            items_records = await conn.fetch(
-                """
-                SELECT 
-                    sd.product_name,
-                    sd.size_name,
-                    sd.color_name,
-                    sd.quantity,
-                    sd.sale_price,
-                    p.precio_web as original_price,
-                    CASE WHEN p.has_discount = 1 THEN p.discount_percentage ELSE 0 END as current_discount_percentage
-                FROM sales_detail sd
-                LEFT JOIN products p ON sd.product_id = p.id
-                WHERE sd.sale_id = $1
-                """,
-                order_id
+        
+        if outcome == 'no_reservations':
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No se encontraron reservas activas para este pedido"
             )
-            items_list = [dict(i) for i in items_records]
+        
+        confirmed_at = result['confirmed_at']
+        purchase_history_cache.pop(result['web_user_id'])
+        
+        # Order and customer details for the emails
+        order = dict(result, id=order_id)
+        
+        # Fetch items to show in the email (sales_detail is immutable, no
+        # need to keep the transaction open for it)
+        items_records = await conn.fetch(
+            """
+            SELECT 
+                sd.product_name,
+                sd.size_name,
+                sd.color_name,
+                sd.quantity,
+                sd.sale_price,
+                p.precio_web as original_price,
+                CASE WHEN p.has_discount = 1 THEN p.discount_percentage ELSE 0 END as current_discount_percentage
+            FROM sales_detail sd
+            LEFT JOIN products p ON sd.product_id = p.id
+            WHERE sd.sale_id = $1
+            """,
+            order_id
+        )
+        items_list = [dict(i) for i in items_records]
+        items_count = len(items_list)
 
-            # Prepare tracking link
-            tracking_link = f"{FRONTEND_URL}/order-tracking/{order_id}"
-            
-            # Send email to business
-            try:
-                await send_new_order_notification_to_business(
-                    order_id=order_id,
-                    customer_name=order['fullname'] or order['username'],
-                    customer_email=order['email'],
-                    customer_phone=order.get('phone', ''),
-                    total=float(order['total']),
-                    items_count=items_count,
-                    shipping_address=order['shipping_address'],
-                    delivery_type=order['delivery_type'],
-                    order_link=tracking_link,
-                    customer_notes=order['notes'],
-                    items=items_list,
-                    shipping_cost=float(order.get('shipping_cost') or 0.0),
-                    coupon_discount=float(order.get('coupon_discount_amount') or 0.0)
-                )
-            except Exception as e:
-                print(f"Warning: Failed to send business notification email: {e}")
-            
-            # Send email to customer
-            try:
-                await send_order_status_email(
-                    email=order['email'],
-                    username=order['fullname'] or order['username'],
-                    order_id=order_id,
-                    status='preparando',
-                    description=f'Tu pago ha sido confirmado. Estamos preparando tu pedido.',
-                    base_url=FRONTEND_URL
-                )
-            except Exception as e:
-                print(f"Warning: Failed to send customer notification email: {e}")
-            
-            return {
-                'message': 'Pago confirmado exitosamente',
-                'order_id': order_id,
-                'status': 'Completada',
-                'shipping_status': 'preparando',
-                'tracking_link': tracking_link
-            }
+        # Prepare tracking link
+        tracking_link = f"{FRONTEND_URL}/order-tracking/{order_id}"
+        
+        # Send emails (business + customer) once the transaction has committed;
+        # each goes through the email worker, which logs failed sends
+        enqueue_email(
+            send_new_order_notification_to_business,
+            order_id=order['id'],
+            customer_name=order['fullname'] or order['username'],
+            customer_email=order['email'],
+            customer_phone=order.get('phone', ''),
+            total=float(order['total']),
+            items_count=items_count,
+            shipping_address=order['shipping_address'],
+            delivery_type=order['delivery_type'],
+            order_link=tracking_link,
+            customer_notes=order['notes'],
+            items=items_list,
+            shipping_cost=float(order.get('shipping_cost') or 0.0),
+            coupon_discount=float(order.get('coupon_discount_amount') or 0.0)
+        )
+        enqueue_email(
+            send_order_status_email,
+            email=order['email'],
+            username=order['fullname'] or order['username'],
+            order_id=order['id'],
+            status='preparando',
+            description='Tu pago ha sido confirmado. Estamos preparando tu pedido.',
+            base_url=FRONTEND_URL
+        )
+        
+        return {
+            'message': 'Pago confirmado exitosamente',
+            'order_id': order_id,
+            'status': 'Completada',
+            'shipping_status': 'preparando',
+            'confirmed_at': confirmed_at,
+            'tracking_link': tracking_link
+        }
 
 
 @router.post("/{order_id}/cancel")
@@ -1145,25 +990,18 @@ async def cancel_order(
     2. Updates order status to 'Cancelada'
     3. Marks stock reservations as 'cancelled'
     4. Creates tracking entry
-    5. Optionally sends email to customer
+    5. Optionally queues an email to the customer
     
     Reasons: 'expired', 'user_cancelled', 'payment_failed'
     
     Requires Authorization header with Bearer token.
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    current_user = await get_user_by_token(token)
+    await get_current_user(authorization)
     
-    pool = await DatabaseManager.get_pool()
-    
-    async with pool.acquire() as conn:
-        async with conn.transaction():
+    async with DatabaseManager.acquire() as conn:
+        async with conn.transaction(isolation='read_committed'):
+            await set_order_tx_timeouts(conn)
+            
             # Get order details
             order = await conn.fetchrow(
                 """
@@ -1187,74 +1025,38 @@ async def cancel_order(
                     detail="Pedido no encontrado"
                 )
             
-            # Update order status
-            await conn.execute(
-                """
-                UPDATE sales
-                SET status = 'Cancelada',
-                    shipping_status = 'cancelado',
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE id = $1
-                """,
-                order_id
-            )
-            
-            # Release stock reservations
-            reservations_updated = await conn.execute(
-                """
-                UPDATE stock_reservations
-                SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
-                WHERE sale_id = $1 AND status = 'active'
-                """,
-                order_id
-            )
-            
-            # Create tracking entry
-            reason_text = {
-                'expired': 'Pedido cancelado automáticamente por expiración de reserva',
-                'user_cancelled': 'Pedido cancelado por el cliente',
-                'payment_failed': 'Pedido cancelado por fallo en el pago'
-            }.get(cancel_data.reason, 'Pedido cancelado')
+            # Update order status, release stock reservations and create the tracking entry
+            reason_text = _REASON_TEXT.get(cancel_data.reason, 'Pedido cancelado')
             
-            await conn.execute(
-                """
-                INSERT INTO sales_tracking_history (
-                    sale_id,
-                    status,
-                    description,
-                    location,
-                    changed_by_user_id,
-                    created_at
-                )
-                VALUES ($1, $2, $3, $4, NULL, CURRENT_TIMESTAMP)
-                """,
+            cancelled_at = await conn.fetchval(
+                SQL_CANCEL_ORDER,
                 order_id,
-                'cancelado',
-                reason_text + (f'. {cancel_data.notes}' if cancel_data.notes else ''),
-                'Sistema Web'
+                f'{reason_text}. {cancel_data.notes}' if cancel_data.notes else reason_text
             )
             
             # Send email to customer if user cancelled
             if cancel_data.reason == 'user_cancelled' and order['email']:
-                try:
-                    await send_order_status_email(
-                        email=order['email'],
-                        username=order['fullname'] or order['username'],
-                        order_id=order_id,
-                        status='cancelado',
-                        description='Tu pedido ha sido cancelado según tu solicitud.',
-                        base_url=FRONTEND_URL
-                    )
-                except Exception as e:
-                    print(f"Warning: Failed to send cancellation email: {e}")
-            
-            return {
-                'message': 'Pedido cancelado exitosamente',
-                'order_id': order_id,
-                'status': 'Cancelada',
-                'stock_released': True,
-                'reason': cancel_data.reason
-            }
+                enqueue_email(
+                    send_order_status_email,
+                    email=order['email'],
+                    username=order['fullname'] or order['username'],
+                    order_id=order_id,
+                    status='cancelado',
+                    description='Tu pedido ha sido cancelado según tu solicitud.',
+                    base_url=FRONTEND_URL
+                )
+        
+        # After the commit (see create_order)
+        purchase_history_cache.pop(order['web_user_id'])
+        
+        return {
+            'message': 'Pedido cancelado exitosamente',
+            'order_id': order_id,
+            'status': 'Cancelada',
+            'stock_released': True,
+            'reason': cancel_data.reason,
+            'cancelled_at': cancelled_at
+        }
 
 
 @router.post("/{purchase_id}/tracking")
@@ -1276,21 +1078,11 @@ async def update_tracking_history(
     
     Requires Authorization header with Bearer token.
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    
     # For now, we'll use the web user token, but in production you might want
     # to validate that this is an admin/employee user
-    current_user = await get_user_by_token(token)
+    await get_current_user(authorization)
     
-    pool = await DatabaseManager.get_pool()
-    
-    async with pool.acquire() as conn:
+    async with DatabaseManager.acquire() as conn:
         # Verify sale exists
         sale = await conn.fetchrow(
             """
@@ -1343,23 +1135,22 @@ async def update_tracking_history(
             tracking_data.status,
             purchase_id
         )
+        purchase_history_cache.pop(sale['web_user_id'])
         
         # Send email notification to customer if requested
         email_sent = False
         if tracking_data.notify_customer and sale['email']:
-            try:
-                await send_order_status_email(
-                    email=sale['email'],
-                    username=sale['fullname'] or sale['username'],
-                    order_id=purchase_id,
-                    status=tracking_data.status,
-                    description=tracking_data.description,
-                    base_url=FRONTEND_URL
-                )
-                email_sent = True
-            except Exception as e:
-                # Log error but don't fail the tracking update
-                print(f"Warning: Failed to send customer notification email: {e}")
+            # Queued: delivery failures are logged by the email worker
+            enqueue_email(
+                send_order_status_email,
+                email=sale['email'],
+                username=sale['fullname'] or sale['username'],
+                order_id=purchase_id,
+                status=tracking_data.status,
+                description=tracking_data.description,
+                base_url=FRONTEND_URL
+            )
+            email_sent = True
         
         return {
             'message': 'Historial de rastreo actualizado exitosamente',
@@ -1369,7 +1160,7 @@ async def update_tracking_history(
                 'status': tracking_entry['status'],
                 'description': tracking_entry['description'],
                 'location': tracking_entry['location'],
-                'created_at': tracking_entry['created_at'].isoformat() if hasattr(tracking_entry['created_at'], 'isoformat') else str(tracking_entry['created_at']),
+                'created_at': tracking_entry['created_at'],
                 'changed_by': 'admin'  # For now, hardcoded
             },
             'email_sent': email_sent
@@ -6,9 +6,17 @@ Uses FastAPI-Mail for email verification and notifications.
 
 from fastapi import APIRouter, HTTPException, Header, status
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import asyncpg
 import bcrypt
-import uuid
+import hashlib
+import hmac
+import secrets
 from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
 
 from models.user_models import (
     UserRegister, UserLogin, UserResponse, TokenResponse,
@@ -16,53 +24,140 @@ from models.user_models import (
     GoogleAuthCallback, GoogleUserInfo, PasswordResetRequest, PasswordResetConfirm
 )
 from config.db_connection import DatabaseManager
-from utils.email import send_verification_email, send_password_reset_email
+from utils.email import send_verification_email, send_password_reset_email, send_welcome_email
+from utils.email_tasks import enqueue_email
+from utils.responses import ORJSONResponse
+from utils.cache import session_profile_cache, verified_password_cache
+from utils.auth import invalidate_token, _token_key
 
 router = APIRouter()
 
+# bcrypt releases the GIL while hashing, so a thread per core runs hashes in
+# parallel without blocking the event loop (and without process pickling)
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
+
+# Keys verified_password_cache; random per process, so cache keys can't be
+# precomputed or reused elsewhere
+_VERIFY_CACHE_PEPPER = os.urandom(32)
+
+# Checked when a login names no existing user, so unknown usernames take as
+# long as wrong passwords (same cost factor as hash_password)
+_DUMMY_PASSWORD_HASH = bcrypt.hashpw(os.urandom(16), bcrypt.gensalt()).decode('utf-8')
+
+# Hot SQL, kept as module constants so every call reuses the same
+# prepared statement (see DatabaseManager.register_hot_statements)
+SQL_USER_BY_TOKEN = """
+SELECT id, username, fullname, email, phone, domicilio, cuit, 
+       provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
+       role, status, profile_image_url, email_verified, created_at
+FROM web_users
+WHERE session_token = $1 AND status = 'active'
+"""
+
+# Login reads only what the password / status checks need; the profile
+# comes back from the session token UPDATE itself (SQL_START_SESSION)
+SQL_LOGIN_LOOKUP = """
+SELECT id, status, password
+FROM web_users
+WHERE (username = $1 OR email = $1)
+"""
+
+# Also returns the token being replaced, so its cached lookups can be dropped
+SQL_START_SESSION = """
+UPDATE web_users w
+SET session_token = $2
+FROM (SELECT session_token FROM web_users WHERE id = $1 FOR UPDATE) previous
+WHERE w.id = $1
+RETURNING w.id, w.username, w.fullname, w.email, w.phone, w.domicilio, w.cuit, 
+          w.provincia, w.ciudad, w.calle, w.numero, w.piso, w.departamento, w.codigo_postal,
+          w.role, w.status, w.profile_image_url, w.email_verified, w.created_at,
+          previous.session_token AS previous_session_token
+"""
+
+SQL_CLEAR_SESSION_TOKEN = "UPDATE web_users SET session_token = NULL WHERE session_token = $1"
+
+# Columns PUT /me may change (anything else in the payload is ignored)
+_PROFILE_UPDATE_COLUMNS = frozenset({
+    'fullname', 'email', 'phone', 'domicilio', 'profile_image_url', 'cuit',
+    'provincia', 'ciudad', 'calle', 'numero', 'piso', 'departamento', 'codigo_postal',
+})
+
+DatabaseManager.register_hot_statements(
+    SQL_USER_BY_TOKEN,
+    SQL_LOGIN_LOOKUP,
+    SQL_START_SESSION,
+    SQL_CLEAR_SESSION_TOKEN,
+)
+
 
 # Helper functions
-def hash_password(password: str) -> str:
-    """Hash a password using bcrypt."""
+async def hash_password(password: str) -> str:
+    """Hash a password using bcrypt (off the event loop)."""
     salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
+    loop = asyncio.get_running_loop()
+    hashed = await loop.run_in_executor(_BCRYPT_POOL, bcrypt.hashpw, password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash."""
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verify a password against its hash (off the event loop).
+
+    Successful checks are remembered for a while, so repeated logins with
+    the same credentials skip bcrypt entirely.
+    """
+    plain = plain_password.encode('utf-8')
+    hashed = hashed_password.encode('utf-8')
+    cache_key = hmac.new(_VERIFY_CACHE_PEPPER, plain + b'\0' + hashed, hashlib.sha256).digest()
+    if verified_password_cache.get(cache_key):
+        return True
+    
+    loop = asyncio.get_running_loop()
+    valid = await loop.run_in_executor(_BCRYPT_POOL, bcrypt.checkpw, plain, hashed)
+    if valid:
+        verified_password_cache.set(cache_key, True)
+    return valid
+
+
+def _duplicate_detail(error: asyncpg.UniqueViolationError, **details: str) -> str:
+    """Pick the error message for the unique constraint that was violated."""
+    constraint = error.constraint_name or ''
+    for field, detail in details.items():
+        if field in constraint:
+            return detail
+    return "Duplicate value"
 
 
 def generate_session_token() -> str:
     """Generate a unique session token."""
-    return str(uuid.uuid4())
+    return secrets.token_urlsafe(32)
 
 
 def generate_verification_token() -> str:
     """Generate a unique email verification token."""
-    return str(uuid.uuid4())
+    return secrets.token_urlsafe(32)
 
 
 async def get_user_by_token(token: str):
-    """Get user by session token."""
-    pool = await DatabaseManager.get_pool()
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow(
-            """
-            SELECT id, username, fullname, email, phone, domicilio, cuit, 
-                   provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
-                   role, status, profile_image_url, email_verified, created_at
-            FROM web_users
-            WHERE session_token = $1 AND status = 'active'
-            """,
-            token
-        )
+    """
+    Get the full profile for a session token (cached for a minute per token).
+
+    Keyed like utils.auth's caches; utils.auth.invalidate_token() drops it.
+    """
+    key = _token_key(token)
+    cached = session_profile_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+
+    async with DatabaseManager.acquire() as conn:
+        user = await conn.fetchrow(SQL_USER_BY_TOKEN, token)
         if not user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid or expired token"
             )
+        user = dict(user)
+        session_profile_cache.set(key, user)
         return dict(user)
 
 
@@ -82,81 +177,68 @@ async def register(user_data: UserRegister):
     
     After registration, user will receive a verification email.
     """
+    # Hash password and generate tokens (before taking a pool connection)
+    hashed_password = await hash_password(user_data.password)
+    session_token = generate_session_token()
+    verification_token = generate_verification_token()
+    
     pool = await DatabaseManager.get_pool()
     
     async with pool.acquire() as conn:
-        # Check if username already exists
-        existing_user = await conn.fetchrow(
-            "SELECT id FROM web_users WHERE username = $1",
-            user_data.username
-        )
-        if existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Username already exists"
+        # Insert new user (username / email / cuit uniqueness is enforced by the DB)
+        try:
+            new_user = await conn.fetchrow(
+                """
+                INSERT INTO web_users 
+                (username, fullname, email, password, phone, domicilio, cuit, 
+                 provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
+                 role, status, session_token, email_verified, verification_token)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
+                RETURNING id, username, fullname, email, phone, domicilio, cuit, 
+                          provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
+                          role, status, profile_image_url, email_verified, created_at
+                """,
+                user_data.username,
+                user_data.fullname,
+                user_data.email,
+                hashed_password,
+                user_data.phone,
+                user_data.domicilio,
+                user_data.cuit,
+                user_data.provincia,
+                user_data.ciudad,
+                user_data.calle,
+                user_data.numero,
+                user_data.piso,
+                user_data.departamento,
+                user_data.codigo_postal,
+                "customer",  # Default role
+                "active",    # Default status
+                session_token,
+                False,       # email_verified
+                verification_token
             )
-        
-        # Check if email already exists
-        existing_email = await conn.fetchrow(
-            "SELECT id FROM web_users WHERE email = $1",
-            user_data.email
-        )
-        if existing_email:
+        except asyncpg.UniqueViolationError as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already registered"
+                detail=_duplicate_detail(
+                    e,
+                    username="Username already exists",
+                    email="Email already registered",
+                    cuit="CUIT already in use by another user"
+                )
             )
         
-        # Hash password and generate tokens
-        hashed_password = hash_password(user_data.password)
-        session_token = generate_session_token()
-        verification_token = generate_verification_token()
-        
-        # Insert new user
-        new_user = await conn.fetchrow(
-            """
-            INSERT INTO web_users 
-            (username, fullname, email, password, phone, domicilio, cuit, 
-             provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
-             role, status, session_token, email_verified, verification_token)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
-            RETURNING id, username, fullname, email, phone, domicilio, cuit, 
-                      provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
-                      role, status, profile_image_url, email_verified, created_at
-            """,
-            user_data.username,
-            user_data.fullname,
-            user_data.email,
-            hashed_password,
-            user_data.phone,
-            user_data.domicilio,
-            user_data.cuit,
-            user_data.provincia,
-            user_data.ciudad,
-            user_data.calle,
-            user_data.numero,
-            user_data.piso,
-            user_data.departamento,
-            user_data.codigo_postal,
-            "customer",  # Default role
-            "active",    # Default status
-            session_token,
-            False,       # email_verified
-            verification_token
-        )
-        
         user_response = UserResponse(**dict(new_user))
         
-        # Send verification email
-        try:
-            await send_verification_email(
-                email=user_data.email,
-                username=user_data.username,
-                verification_token=verification_token
-            )
-        except Exception as e:
-            # Log error but don't fail registration
-            print(f"Error sending verification email: {e}")
+        # Send verification email (background email worker, failures are
+        # logged there and don't fail registration)
+        enqueue_email(
+            send_verification_email,
+            email=user_data.email,
+            username=user_data.username,
+            verification_token=verification_token
+        )
         
         return TokenResponse(
             token=session_token,
@@ -175,9 +257,21 @@ async def verify_email(verification_data: EmailVerification):
     pool = await DatabaseManager.get_pool()
     
     async with pool.acquire() as conn:
-        # Find user by verification token
+        # Find the user by verification token and mark it as verified in one statement
         user = await conn.fetchrow(
-            "SELECT id, username, email, email_verified FROM web_users WHERE verification_token = $1",
+            """
+            WITH target AS (
+                SELECT id, email_verified
+                FROM web_users
+                WHERE verification_token = $1
+                FOR UPDATE
+            )
+            UPDATE web_users wu
+            SET email_verified = TRUE, verification_token = NULL
+            FROM target
+            WHERE wu.id = target.id
+            RETURNING wu.id, wu.username, wu.email, target.email_verified AS was_verified
+            """,
             verification_data.token
         )
         
@@ -187,29 +281,15 @@ async def verify_email(verification_data: EmailVerification):
                 detail="Invalid or expired verification token"
             )
         
-        if user['email_verified']:
+        if user['was_verified']:
             return {"message": "Email already verified"}
-        
-        # Update user as verified
-        await conn.execute(
-            """
-            UPDATE web_users 
-            SET email_verified = TRUE, verification_token = NULL 
-            WHERE id = $1
-            """,
-            user['id']
-        )
     
-    # Send welcome email after successful verification
-    try:
-        from utils.email import send_welcome_email
-        await send_welcome_email(
-            email=user['email'],
-            username=user['username']
-        )
-    except Exception as e:
-        # Log error but don't fail verification
-        print(f"Error sending welcome email: {e}")
+    # Send welcome email after successful verification (background email worker)
+    enqueue_email(
+        send_welcome_email,
+        email=user['email'],
+        username=user['username']
+    )
     
     return {"message": "Email verified successfully"}
 
@@ -224,41 +304,46 @@ async def resend_verification(resend_data: ResendVerification):
     pool = await DatabaseManager.get_pool()
     
     async with pool.acquire() as conn:
-        # Find user by email
+        # Find the unverified user by email (partial index, migration 028)
         user = await conn.fetchrow(
-            "SELECT id, username, email, email_verified, verification_token FROM web_users WHERE email = $1",
+            """
+            SELECT id, username, email, verification_token
+            FROM web_users
+            WHERE email = $1 AND email_verified = FALSE
+            """,
             resend_data.email
         )
         
         if not user:
+            # Rare path: tell an already verified account apart from a missing one
+            if await conn.fetchval(
+                "SELECT 1 FROM web_users WHERE email = $1 AND email_verified = TRUE",
+                resend_data.email
+            ):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Email already verified"
+                )
             # Don't reveal if email exists or not for security
             return {"message": "If the email exists, a verification link has been sent"}
         
-        if user['email_verified']:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Email already verified"
+        # Reuse the pending token; only write when a new one is needed
+        verification_token = user['verification_token']
+        if not verification_token:
+            verification_token = generate_verification_token()
+            await conn.execute(
+                "UPDATE web_users SET verification_token = $1 WHERE id = $2",
+                verification_token,
+                user['id']
             )
         
-        # Generate new verification token if needed
-        verification_token = user['verification_token'] or generate_verification_token()
-        
-        await conn.execute(
-            "UPDATE web_users SET verification_token = $1 WHERE id = $2",
-            verification_token,
-            user['id']
+        # Send verification email (background email worker)
+        enqueue_email(
+            send_verification_email,
+            email=user['email'],
+            username=user['username'],
+            verification_token=verification_token
         )
-        
-        # Send verification email
-        try:
-            await send_verification_email(
-                email=user['email'],
-                username=user['username'],
-                verification_token=verification_token
-            )
-        except Exception as e:
-            # Log error but don't reveal to user
-            print(f"Error sending verification email: {e}")
     
     return {"message": "If the email exists, a verification link has been sent"}
 
@@ -277,25 +362,13 @@ async def login(credentials: UserLogin):
     
     async with pool.acquire() as conn:
         # Try to find user by username or email
-        user = await conn.fetchrow(
-            """
-            SELECT id, username, fullname, email, phone, domicilio, cuit, 
-                   provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
-                   role, status, profile_image_url, email_verified, created_at, password
-            FROM web_users
-            WHERE (username = $1 OR email = $1)
-            """,
-            credentials.username
-        )
+        user = await conn.fetchrow(SQL_LOGIN_LOOKUP, credentials.username)
         
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid username or password"
-            )
-        
-        # Verify password
-        if not verify_password(credentials.password, user['password']):
+        # Verify password (against a dummy hash for unknown users, so both
+        # failures cost the same bcrypt check)
+        password_hash = user['password'] if user else _DUMMY_PASSWORD_HASH
+        password_ok = await verify_password(credentials.password, password_hash)
+        if not user or not password_ok:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid username or password"
@@ -319,17 +392,10 @@ async def login(credentials: UserLogin):
         # Generate new session token
         session_token = generate_session_token()
         
-        # Update session token in database
-        await conn.execute(
-            "UPDATE web_users SET session_token = $1 WHERE id = $2",
-            session_token,
-            user['id']
-        )
-        
-        # Remove password from user data
-        user_dict = dict(user)
-        user_dict.pop('password')
-        user_response = UserResponse(**user_dict)
+        # Store the session token and get the profile back in the same round-trip
+        profile = dict(await conn.fetchrow(SQL_START_SESSION, user['id'], session_token))
+        invalidate_token(profile.pop('previous_session_token'))
+        user_response = UserResponse(**profile)
         
         return TokenResponse(
             token=session_token,
@@ -351,15 +417,14 @@ async def logout(authorization: Optional[str] = Header(None)):
             detail="Missing or invalid authorization header"
         )
     
-    token = authorization.replace("Bearer ", "")
+    token = authorization[7:]
     pool = await DatabaseManager.get_pool()
     
     async with pool.acquire() as conn:
         # Clear session token
-        result = await conn.execute(
-            "UPDATE web_users SET session_token = NULL WHERE session_token = $1",
-            token
-        )
+        result = await conn.execute(SQL_CLEAR_SESSION_TOKEN, token)
+        
+        invalidate_token(token)
         
         if result == "UPDATE 0":
             raise HTTPException(
@@ -383,7 +448,7 @@ async def get_current_user(authorization: Optional[str] = Header(None)):
             detail="Missing or invalid authorization header"
         )
     
-    token = authorization.replace("Bearer ", "")
+    token = authorization[7:]
     user = await get_user_by_token(token)
     
     return UserResponse(**user)
@@ -405,105 +470,51 @@ async def update_current_user(
             detail="Missing or invalid authorization header"
         )
     
-    token = authorization.replace("Bearer ", "")
+    token = authorization[7:]
     current_user = await get_user_by_token(token)
     
     pool = await DatabaseManager.get_pool()
     
-    # Build update query dynamically based on provided fields
-    update_fields = []
-    values = []
-    param_count = 1
+    # Only the columns a user may edit on their own profile, in model order
+    fields = {
+        column: value
+        for column, value in user_update.model_dump(exclude_unset=True, exclude_none=True).items()
+        if column in _PROFILE_UPDATE_COLUMNS
+    }
     
-    if user_update.fullname is not None:
-        update_fields.append(f"fullname = ${param_count}")
-        values.append(user_update.fullname)
-        param_count += 1
-    
-    if user_update.email is not None:
-        # Check if email is already used by another user
-        async with pool.acquire() as conn:
-            existing = await conn.fetchrow(
-                "SELECT id FROM web_users WHERE email = $1 AND id != $2",
-                user_update.email,
-                current_user['id']
-            )
-            if existing:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Email already in use"
-                )
-        
-        update_fields.append(f"email = ${param_count}")
-        values.append(user_update.email)
-        param_count += 1
-    
-    if user_update.phone is not None:
-        update_fields.append(f"phone = ${param_count}")
-        values.append(user_update.phone)
-        param_count += 1
-    
-    if user_update.domicilio is not None:
-        update_fields.append(f"domicilio = ${param_count}")
-        values.append(user_update.domicilio)
-        param_count += 1
-    
-    if user_update.profile_image_url is not None:
-        update_fields.append(f"profile_image_url = ${param_count}")
-        values.append(user_update.profile_image_url)
-        param_count += 1
-        
-    if user_update.cuit is not None:
-        # Check if cuit is already used by another user
-        async with pool.acquire() as conn:
-            existing = await conn.fetchrow(
-                "SELECT id FROM web_users WHERE cuit = $1 AND id != $2",
-                user_update.cuit,
-                current_user['id']
-            )
-            if existing:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="CUIT already in use by another user"
-                )
-        
-        update_fields.append(f"cuit = ${param_count}")
-        values.append(user_update.cuit)
-        param_count += 1
-        
-    # Address fields
-    address_fields = ['provincia', 'ciudad', 'calle', 'numero', 'piso', 'departamento', 'codigo_postal']
-    for field in address_fields:
-        val = getattr(user_update, field)
-        if val is not None:
-            update_fields.append(f"{field} = ${param_count}")
-            values.append(val)
-            param_count += 1
-
-
-        
-
-    
-    if not update_fields:
+    if not fields:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No fields to update"
         )
     
-    # Add user ID as last parameter
-    values.append(current_user['id'])
+    # User ID is $1, the new values follow
+    set_clause = ', '.join(f"{column} = ${i}" for i, column in enumerate(fields, start=2))
     
     query = f"""
         UPDATE web_users 
-        SET {', '.join(update_fields)}
-        WHERE id = ${param_count}
+        SET {set_clause}
+        WHERE id = $1
         RETURNING id, username, fullname, email, phone, domicilio, cuit, 
                   provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
                   role, status, profile_image_url, email_verified, created_at
     """
     
-    async with pool.acquire() as conn:
-        updated_user = await conn.fetchrow(query, *values)
+    # Email / cuit uniqueness is enforced by the DB
+    try:
+        async with pool.acquire() as conn:
+            updated_user = await conn.fetchrow(query, current_user['id'], *fields.values())
+    except asyncpg.UniqueViolationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=_duplicate_detail(
+                e,
+                email="Email already in use",
+                cuit="CUIT already in use by another user"
+            )
+        )
+    
+    invalidate_token(token)
     
     return UserResponse(**dict(updated_user))
 
@@ -524,7 +535,7 @@ async def change_password(
             detail="Missing or invalid authorization header"
         )
     
-    token = authorization.replace("Bearer ", "")
+    token = authorization[7:]
     current_user = await get_user_by_token(token)
     
     pool = await DatabaseManager.get_pool()
@@ -537,14 +548,14 @@ async def change_password(
         )
         
         # Verify current password
-        if not verify_password(password_data.current_password, user['password']):
+        if not await verify_password(password_data.current_password, user['password']):
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Current password is incorrect"
             )
         
         # Hash new password
-        new_hashed_password = hash_password(password_data.new_password)
+        new_hashed_password = await hash_password(password_data.new_password)
         
         # Update password
         await conn.execute(
@@ -553,6 +564,8 @@ async def change_password(
             current_user['id']
         )
     
+    invalidate_token(token)
+    
     return {"message": "Password changed successfully"}
 
 
@@ -577,7 +590,7 @@ async def forgot_password(request: PasswordResetRequest):
             return {"message": "If the email exists, a password reset link has been sent"}
         
         # Generate token and expiration (1 hour)
-        reset_token = str(uuid.uuid4())
+        reset_token = secrets.token_urlsafe(32)
         
         # Update user with token and expiration
         # Note: Using NOW() + INTERVAL '1 hour' for expiration
@@ -592,16 +605,13 @@ async def forgot_password(request: PasswordResetRequest):
             user['id']
         )
         
-        # Send email
-        try:
-            await send_password_reset_email(
-                email=user['email'],
-                username=user['username'],
-                reset_token=reset_token
-            )
-        except Exception as e:
-            print(f"Error sending password reset email: {e}")
-            # Log error but return success to user/frontend
+        # Send email (background email worker)
+        enqueue_email(
+            send_password_reset_email,
+            email=user['email'],
+            username=user['username'],
+            reset_token=reset_token
+        )
             
     return {"message": "If the email exists, a password reset link has been sent"}
 
@@ -635,7 +645,7 @@ async def reset_password(reset_data: PasswordResetConfirm):
             )
         
         # Hash new password
-        hashed_password = hash_password(reset_data.new_password)
+        hashed_password = await hash_password(reset_data.new_password)
         
         # Update user: set new password and clear reset fields
         await conn.execute(
@@ -799,11 +809,8 @@ async def google_callback(code: str, state: Optional[str] = None):
                 # User exists, generate new session token
                 session_token = generate_session_token()
                 
-                await conn.execute(
-                    "UPDATE web_users SET session_token = $1 WHERE id = $2",
-                    session_token,
-                    user['id']
-                )
+                session = await conn.fetchrow(SQL_START_SESSION, user['id'], session_token)
+                invalidate_token(session['previous_session_token'])
         
         # Redirect to frontend with session token
         from fastapi.responses import RedirectResponse
@@ -827,7 +834,7 @@ async def update_user_by_admin(user_id: int, user_update: UserUpdate):
     
     Allows administrators to update any user's personal information including:
     - Full name
-    - Email (with uniqueness validation)
+    - Email (unique, enforced by the database)
     - Phone number
     - Address (domicilio)
     - Profile image URL
@@ -870,18 +877,6 @@ async def update_user_by_admin(user_id: int, user_update: UserUpdate):
             param_count += 1
         
         if user_update.email is not None:
-            # Check if email is already used by another user
-            existing = await conn.fetchrow(
-                "SELECT id FROM web_users WHERE email = $1 AND id != $2",
-                user_update.email,
-                user_id
-            )
-            if existing:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="Email already in use by another user"
-                )
-            
             update_fields.append(f"email = ${param_count}")
             values.append(user_update.email)
             param_count += 1
@@ -902,18 +897,6 @@ async def update_user_by_admin(user_id: int, user_update: UserUpdate):
             param_count += 1
 
         if user_update.cuit is not None:
-            # Check if cuit is already used by another user
-            existing = await conn.fetchrow(
-                "SELECT id FROM web_users WHERE cuit = $1 AND id != $2",
-                user_update.cuit,
-                user_id
-            )
-            if existing:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="CUIT already in use by another user"
-                )
-            
             update_fields.append(f"cuit = ${param_count}")
             values.append(user_update.cuit)
             param_count += 1
@@ -943,12 +926,26 @@ async def update_user_by_admin(user_id: int, user_update: UserUpdate):
             WHERE id = ${param_count}
             RETURNING id, username, fullname, email, phone, domicilio, cuit, 
                       provincia, ciudad, calle, numero, piso, departamento, codigo_postal,
-                      role, status, profile_image_url, email_verified, created_at
+                      role, status, profile_image_url, email_verified, created_at, session_token
         """
         
-        updated_user = await conn.fetchrow(query, *values)
+        # Email / cuit uniqueness is enforced by the DB
+        try:
+            updated_user = await conn.fetchrow(query, *values)
+        except asyncpg.UniqueViolationError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=_duplicate_detail(
+                    e,
+                    email="Email already in use by another user",
+                    cuit="CUIT already in use by another user"
+                )
+            )
         
-        return UserResponse(**dict(updated_user))
+        # Drop the cached session so the user's next request sees the new data
+        updated_user = dict(updated_user)
+        invalidate_token(updated_user.pop('session_token'))
+        return UserResponse(**updated_user)
 
 
 @router.get("/{user_id}/activity")
@@ -969,9 +966,11 @@ async def get_user_activity(user_id: int):
     """
     pool = await DatabaseManager.get_pool()
     
-    async with pool.acquire() as conn:
-        # Get user profile
-        user = await conn.fetchrow(
+    # The five reads are independent (all keyed by the user), so run them
+    # concurrently on separate pool connections
+    user, purchases, products_ordered, tracking_rows, payment_rows, stats = await asyncio.gather(
+        # User profile
+        pool.fetchrow(
             """
             SELECT id, username, fullname, email, phone, domicilio, cuit, 
                    role, status, profile_image_url, email_verified, created_at
@@ -979,16 +978,9 @@ async def get_user_activity(user_id: int):
             WHERE id = $1
             """,
             user_id
-        )
-        
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"User with ID {user_id} not found"
-            )
-        
-        # Get purchase history
-        purchases = await conn.fetch(
+        ),
+        # Purchase history
+        pool.fetch(
             """
             SELECT 
                 s.id as sale_id,
@@ -1003,10 +995,9 @@ async def get_user_activity(user_id: int):
             ORDER BY s.sale_date DESC
             """,
             user_id
-        )
-        
-        # Get all products ordered
-        products_ordered = await conn.fetch(
+        ),
+        # All products ordered
+        pool.fetch(
             """
             SELECT 
                 sd.sale_id,
@@ -1026,129 +1017,164 @@ async def get_user_activity(user_id: int):
             ORDER BY s.sale_date DESC, sd.id
             """,
             user_id
+        ),
+        # Tracking history of all those purchases
+        pool.fetch(
+            """
+            SELECT 
+                sth.sale_id,
+                sth.status,
+                sth.description,
+                sth.location,
+                sth.created_at
+            FROM sales_tracking_history sth
+            JOIN sales s ON s.id = sth.sale_id
+            WHERE s.web_user_id = $1 AND s.origin = 'web'
+            ORDER BY sth.sale_id, sth.created_at ASC
+            """,
+            user_id
+        ),
+        # Payment info of all those purchases
+        pool.fetch(
+            """
+            SELECT 
+                sp.sale_id,
+                sp.id as payment_id,
+                pm.method_name,
+                pm.display_name,
+                b.name as bank_name,
+                sp.created_at as payment_date
+            FROM sales_payments sp
+            JOIN sales s ON s.id = sp.sale_id
+            JOIN banks_payment_methods bpm ON bpm.id = sp.payment_method_id
+            JOIN payment_methods pm ON pm.id = bpm.payment_method_id
+            LEFT JOIN banks b ON b.id = bpm.bank_id
+            WHERE s.web_user_id = $1 AND s.origin = 'web'
+            ORDER BY sp.sale_id, sp.id
+            """,
+            user_id
+        ),
+        # Statistics, aggregated server-side
+        pool.fetchrow(
+            """
+            SELECT 
+                COUNT(*) as total_purchases,
+                COALESCE(SUM(s.total), 0) as total_spent,
+                (
+                    SELECT COALESCE(SUM(sd.quantity), 0)
+                    FROM sales_detail sd
+                    JOIN sales s2 ON s2.id = sd.sale_id
+                    WHERE s2.web_user_id = $1 AND s2.origin = 'web'
+                ) as total_products_ordered
+            FROM sales s
+            WHERE s.web_user_id = $1 AND s.origin = 'web'
+            """,
+            user_id
+        ),
+    )
+    
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"User with ID {user_id} not found"
         )
-        
-        # Format response
-        user_data = dict(user)
-        
-        # Format purchases with tracking history and payment info
-        purchases_list = []
-        for purchase in purchases:
-            sale_id = purchase['sale_id']
-            
-            # Get full tracking history for this purchase
-            tracking_history = await conn.fetch(
-                """
-                SELECT 
-                    status,
-                    description,
-                    location,
-                    created_at
-                FROM sales_tracking_history
-                WHERE sale_id = $1
-                ORDER BY created_at ASC
-                """,
-                sale_id
-            )
-            
-            # Get payment information
-            payment_info = await conn.fetch(
-                """
-                SELECT 
-                    sp.id as payment_id,
-                    pm.method_name,
-                    pm.display_name,
-                    b.name as bank_name,
-                    sp.created_at as payment_date
-                FROM sales_payments sp
-                JOIN banks_payment_methods bpm ON bpm.id = sp.payment_method_id
-                JOIN payment_methods pm ON pm.id = bpm.payment_method_id
-                LEFT JOIN banks b ON b.id = bpm.bank_id
-                WHERE sp.sale_id = $1
-                """,
-                sale_id
-            )
-            
-            # Format tracking history
-            tracking_list = []
-            for track in tracking_history:
-                tracking_list.append({
-                    "status": track['status'],
-                    "description": track['description'],
-                    "location": track['location'],
-                    "timestamp": track['created_at'].isoformat() if track['created_at'] else None
-                })
-            
-            # Format payment info
-            payment_list = []
-            for payment in payment_info:
-                payment_list.append({
-                    "payment_id": payment['payment_id'],
-                    "method_name": payment['method_name'],
-                    "display_name": payment['display_name'],
-                    "bank_name": payment['bank_name'],
-                    "payment_date": payment['payment_date'].isoformat() if payment['payment_date'] else None
-                })
-            
-            # Get current status (last tracking entry)
-            current_status = tracking_list[-1] if tracking_list else None
-            
-            purchases_list.append({
-                "sale_id": sale_id,
-                "purchase_date": purchase['purchase_date'].isoformat() if purchase['purchase_date'] else None,
-                "total": float(purchase['total']) if purchase['total'] else 0,
-                "origin": purchase['origin'],
-                "shipping_address": purchase['shipping_address'],
-                "delivery_type": purchase['delivery_type'],
-                "notes": purchase['notes'],
-                "current_status": current_status['status'] if current_status else None,
-                "current_status_description": current_status['description'] if current_status else None,
-                "current_status_updated_at": current_status['timestamp'] if current_status else None,
-                "tracking_history": tracking_list,
-                "payment_methods": payment_list
+    
+    # Format response
+    user_data = dict(user)
+    
+    tracking_by_sale = {
+        sale_id: list(rows)
+        for sale_id, rows in groupby(tracking_rows, key=itemgetter('sale_id'))
+    }
+    payments_by_sale = {
+        sale_id: list(rows)
+        for sale_id, rows in groupby(payment_rows, key=itemgetter('sale_id'))
+    }
+    
+    # Format purchases with tracking history and payment info
+    purchases_list = []
+    for purchase in purchases:
+        sale_id = purchase['sale_id']
+        tracking_history = tracking_by_sale.get(sale_id, [])
+        payment_info = payments_by_sale.get(sale_id, [])
+        
+        # Format tracking history
+        tracking_list = []
+        for track in tracking_history:
+            tracking_list.append({
+                "status": track['status'],
+                "description": track['description'],
+                "location": track['location'],
+                "timestamp": track['created_at']
             })
         
-        # Format products
-        products_list = []
-        for product in products_ordered:
-            products_list.append({
-                "sale_id": product['sale_id'],
-                "product_id": product['product_id'],
-                "product_name": product['product_name'],
-                "variant_id": product['variant_id'],
-                "size": product['size'],
-                "color": product['color'],
-                "quantity": product['quantity'],
-                "unit_price": float(product['unit_price']) if product['unit_price'] else 0,
-                "subtotal": float(product['subtotal']) if product['subtotal'] else 0,
-                "discount_applied": float(product['discount_applied']) if product['discount_applied'] else 0,
-                "order_date": product['order_date'].isoformat() if product['order_date'] else None
+        # Format payment info
+        payment_list = []
+        for payment in payment_info:
+            payment_list.append({
+                "payment_id": payment['payment_id'],
+                "method_name": payment['method_name'],
+                "display_name": payment['display_name'],
+                "bank_name": payment['bank_name'],
+                "payment_date": payment['payment_date']
             })
         
-        # Calculate statistics
-        total_purchases = len(purchases_list)
-        total_spent = sum(p['total'] for p in purchases_list)
-        total_products = sum(p['quantity'] for p in products_list)
-        
-        return {
-            "user": {
-                "id": user_data['id'],
-                "username": user_data['username'],
-                "fullname": user_data['fullname'],
-                "email": user_data['email'],
-                "phone": user_data['phone'],
-                "domicilio": user_data['domicilio'],
-                "cuit": user_data['cuit'],
-                "role": user_data['role'],
-                "status": user_data['status'],
-                "email_verified": user_data['email_verified'],
-                "created_at": user_data['created_at'].isoformat() if user_data['created_at'] else None
-            },
-            "statistics": {
-                "total_purchases": total_purchases,
-                "total_spent": total_spent,
-                "total_products_ordered": total_products
-            },
-            "purchases": purchases_list,
-            "products_ordered": products_list
-        }
+        # Get current status (last tracking entry)
+        current_status = tracking_list[-1] if tracking_list else None
+        
+        purchases_list.append({
+            "sale_id": sale_id,
+            "purchase_date": purchase['purchase_date'],
+            "total": purchase['total'] or 0,
+            "origin": purchase['origin'],
+            "shipping_address": purchase['shipping_address'],
+            "delivery_type": purchase['delivery_type'],
+            "notes": purchase['notes'],
+            "current_status": current_status['status'] if current_status else None,
+            "current_status_description": current_status['description'] if current_status else None,
+            "current_status_updated_at": current_status['timestamp'] if current_status else None,
+            "tracking_history": tracking_list,
+            "payment_methods": payment_list
+        })
+    
+    # Format products
+    products_list = []
+    for product in products_ordered:
+        products_list.append({
+            "sale_id": product['sale_id'],
+            "product_id": product['product_id'],
+            "product_name": product['product_name'],
+            "variant_id": product['variant_id'],
+            "size": product['size'],
+            "color": product['color'],
+            "quantity": product['quantity'],
+            "unit_price": product['unit_price'] or 0,
+            "subtotal": product['subtotal'] or 0,
+            "discount_applied": product['discount_applied'] or 0,
+            "order_date": product['order_date']
+        })
+    
+    # Rendered straight by orjson (datetimes / numerics natively), skipping
+    # FastAPI's jsonable_encoder walk over the whole payload
+    return ORJSONResponse({
+        "user": {
+            "id": user_data['id'],
+            "username": user_data['username'],
+            "fullname": user_data['fullname'],
+            "email": user_data['email'],
+            "phone": user_data['phone'],
+            "domicilio": user_data['domicilio'],
+            "cuit": user_data['cuit'],
+            "role": user_data['role'],
+            "status": user_data['status'],
+            "email_verified": user_data['email_verified'],
+            "created_at": user_data['created_at']
+        },
+        "statistics": {
+            "total_purchases": stats['total_purchases'],
+            "total_spent": stats['total_spent'],
+            "total_products_ordered": stats['total_products_ordered']
+        },
+        "purchases": purchases_list,
+        "products_ordered": products_list
+    })
@@ -1,82 +1,198 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Response
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
-from config.db_connection import db
+from config.db_connection import db, PoolBusyError
 from models.waiting_list_models import WaitingListCreate, WaitingListResponse, WaitingListStats
 from utils.auth import require_admin
+from utils.responses import ORJSONResponse, dumps, pool_busy_exception
+from utils.cache import waiting_list_stats_cache
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+_STATS_CACHE_KEY = "top_products"
+
+# Rows pulled from the listing cursor per round-trip
+_STREAM_BATCH_SIZE = 200
+
+# Inserta la solicitud junto con sus talles ($9) y colores ($10) en un solo round-trip
+SQL_CREATE_WAITING_LIST_REQUEST = """
+    WITH new_le AS (
+        INSERT INTO lista_espera (
+            product_id, 
+            codigo_barra_variante,
+            celular_cliente, 
+            nombre_cliente, 
+            producto_buscado, 
+            sucursal_referencia, 
+            talle_buscado, 
+            color_buscado
+        )
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+        RETURNING id, product_id as id_producto, codigo_barra_variante, celular_cliente, nombre_cliente, producto_buscado, 
+                  sucursal_referencia, talle_buscado, color_buscado, notificado, created_at
+    ),
+    talles AS (
+        INSERT INTO lista_espera_talles (waiting_list_id, size_id)
+        SELECT new_le.id, size_id FROM new_le, unnest($9::int[]) AS size_id
+    ),
+    colores AS (
+        INSERT INTO lista_espera_colores (waiting_list_id, color_id)
+        SELECT new_le.id, color_id FROM new_le, unnest($10::int[]) AS color_id
+    )
+    SELECT * FROM new_le
+"""
+
+# Listado con los talles / colores agregados (JSON); los filtros opcionales
+# se agregan entre el SELECT y el ORDER BY
+SQL_WAITING_LIST_SELECT = """
+SELECT 
+    le.id, 
+    le.product_id as id_producto, 
+    COALESCE(
+        le.codigo_barra_variante,
+        (
+            SELECT wsv.variant_barcode 
+            FROM warehouse_stock_variants wsv 
+            JOIN lista_espera_talles let ON let.size_id = wsv.size_id AND let.waiting_list_id = le.id
+            JOIN lista_espera_colores lec ON lec.color_id = wsv.color_id AND lec.waiting_list_id = le.id
+            WHERE wsv.product_id = le.product_id
+            LIMIT 1
+        )
+    ) as codigo_barra_variante,
+    le.celular_cliente, 
+    le.nombre_cliente, 
+    le.producto_buscado, 
+    le.sucursal_referencia, 
+    le.talle_buscado, 
+    le.color_buscado, 
+    le.notificado, 
+    le.created_at,
+    t.talles_detalle,
+    c.colores_detalle
+FROM lista_espera le
+LEFT JOIN LATERAL (
+    SELECT COALESCE(json_agg(json_build_object('id', s.id, 'name', s.size_name)), '[]') as talles_detalle
+    FROM lista_espera_talles let
+    JOIN sizes s ON s.id = let.size_id
+    WHERE let.waiting_list_id = le.id
+) t ON TRUE
+LEFT JOIN LATERAL (
+    SELECT COALESCE(json_agg(json_build_object('id', co.id, 'name', co.color_name, 'hex', co.color_hex)), '[]') as colores_detalle
+    FROM lista_espera_colores lec
+    JOIN colors co ON co.id = lec.color_id
+    WHERE lec.waiting_list_id = le.id
+) c ON TRUE
+"""
+
+SQL_WAITING_LIST_ORDER = " ORDER BY le.created_at DESC"
+
+SQL_WAITING_LIST_STATS = """
+SELECT 
+    producto_buscado, 
+    count
+FROM mv_waiting_list_stats
+ORDER BY count DESC
+"""
+
+SQL_DELETE_WAITING_LIST_REQUEST = "DELETE FROM lista_espera WHERE id = $1 RETURNING id"
+
+# Prepared on every pool connection (the listing without filters is the
+# admin page's default load)
+db.register_hot_statements(
+    SQL_CREATE_WAITING_LIST_REQUEST,
+    SQL_WAITING_LIST_SELECT + SQL_WAITING_LIST_ORDER,
+    SQL_WAITING_LIST_STATS,
+    SQL_DELETE_WAITING_LIST_REQUEST,
+)
+
+async def _stream_json_array(query: str, args: list) -> StreamingResponse:
+    """
+    Stream the rows of ``query`` as one JSON array from a server-side cursor.
+
+    The connection, the read-only transaction and the first batch are set up
+    before the response is returned, so acquire / query errors still reach the
+    route's error handling instead of truncating a 200 body. The connection is
+    released once the last batch has been written.
+    """
+    pool = await db.get_pool()
+    try:
+        conn = await pool.acquire(timeout=db.acquire_timeout())
+    except asyncio.TimeoutError as e:
+        raise PoolBusyError("Timed out waiting for a database connection") from e
+    # Cursors need a transaction; a read-only one skips write bookkeeping
+    tr = conn.transaction(readonly=True)
+    try:
+        await tr.start()
+    except BaseException:
+        await pool.release(conn)
+        raise
+    try:
+        cursor = await conn.cursor(query, *args)
+        first_batch = await cursor.fetch(_STREAM_BATCH_SIZE)
+    except BaseException:
+        try:
+            await tr.rollback()
+        finally:
+            await pool.release(conn)
+        raise
+
+    async def body():
+        try:
+            separator = b"["
+            batch = first_batch
+            while batch:
+                for row in batch:
+                    yield separator + dumps(dict(row))
+                    separator = b","
+                if len(batch) < _STREAM_BATCH_SIZE:
+                    break
+                batch = await cursor.fetch(_STREAM_BATCH_SIZE)
+            yield b"[]" if separator == b"[" else b"]"
+        finally:
+            try:
+                # Nothing to keep from a read-only transaction
+                await tr.rollback()
+            finally:
+                await pool.release(conn)
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
 @router.post("/", response_model=WaitingListResponse, status_code=status.HTTP_201_CREATED)
 async def create_waiting_list_request(request: WaitingListCreate):
     """
     Create a new waiting list request (Public).
     """
     try:
-        # Get transaction context manager (must await the coroutine first)
-        transaction_cm = await db.transaction()
-        async with transaction_cm as conn:
-            # 1. Insertar en la tabla principal
-            query = """
-                INSERT INTO lista_espera (
-                    product_id, 
-                    codigo_barra_variante,
-                    celular_cliente, 
-                    nombre_cliente, 
-                    producto_buscado, 
-                    sucursal_referencia, 
-                    talle_buscado, 
-                    color_buscado
-                )
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-                RETURNING id, product_id, codigo_barra_variante, celular_cliente, nombre_cliente, producto_buscado, 
-                          sucursal_referencia, talle_buscado, color_buscado, notificado, created_at
-            """
-            
-            # Use provided text or default to "Indistinto" if not provided and lists are empty
-            talle_text = request.talle_buscado or "Indistinto"
-            color_text = request.color_buscado or "Indistinto"
-            
-            # If lists are provided, we can generate a text representation for backward compatibility
-            # strict=False avoids error if lists are None
-            
-            result = await conn.fetchrow(
-                query,
-                request.id_producto,
-                request.codigo_barra_variante,
-                request.celular_cliente,
-                request.nombre_cliente,
-                request.producto_buscado,
-                request.sucursal_referencia,
-                talle_text,
-                color_text
-            )
-            
-            waiting_list_id = result['id']
-            
-            # 2. Insertar talles relacionados
-            if request.talle_ids:
-                size_values = [(waiting_list_id, size_id) for size_id in request.talle_ids]
-                await conn.executemany(
-                    "INSERT INTO lista_espera_talles (waiting_list_id, size_id) VALUES ($1, $2)",
-                    size_values
-                )
-                
-            # 3. Insertar colores relacionados
-            if request.color_ids:
-                color_values = [(waiting_list_id, color_id) for color_id in request.color_ids]
-                await conn.executemany(
-                    "INSERT INTO lista_espera_colores (waiting_list_id, color_id) VALUES ($1, $2)",
-                    color_values
-                )
-            
-            # Fetch detailed response if needed, or just return the basic result + IDs
-            response = dict(result)
-            response['talle_ids'] = request.talle_ids
-            response['color_ids'] = request.color_ids
-            return response
+        # Use provided text or default to "Indistinto" if not provided and lists are empty
+        talle_text = request.talle_buscado or "Indistinto"
+        color_text = request.color_buscado or "Indistinto"
+        
+        # Parent row, talles and colores in a single statement (atomic on its own)
+        result = await db.fetch_one(
+            SQL_CREATE_WAITING_LIST_REQUEST,
+            request.id_producto,
+            request.codigo_barra_variante,
+            request.celular_cliente,
+            request.nombre_cliente,
+            request.producto_buscado,
+            request.sucursal_referencia,
+            talle_text,
+            color_text,
+            request.talle_ids or [],
+            request.color_ids or []
+        )
+        
+        # Columns already match WaitingListResponse (trusted DB data), so
+        # render them directly instead of validating through the model
+        response = dict(result)
+        response['talles_detalle'] = None
+        response['colores_detalle'] = None
+        return ORJSONResponse(response, status_code=status.HTTP_201_CREATED)
     except Exception as e:
         logger.error(f"Error creating waiting list request: {e}")
         raise HTTPException(
@@ -96,48 +212,7 @@ async def get_waiting_list(
     - notificado: 'all' (default), 'pending' (false), 'notified' (true)
     """
     try:
-        # Updated query to include relational data using JSON aggregation
-        query = """
-            SELECT 
-                le.id, 
-                le.product_id, 
-                COALESCE(
-                    le.codigo_barra_variante,
-                    (
-                        SELECT wsv.variant_barcode 
-                        FROM warehouse_stock_variants wsv 
-                        JOIN lista_espera_talles let ON let.size_id = wsv.size_id AND let.waiting_list_id = le.id
-                        JOIN lista_espera_colores lec ON lec.color_id = wsv.color_id AND lec.waiting_list_id = le.id
-                        WHERE wsv.product_id = le.product_id
-                        LIMIT 1
-                    )
-                ) as codigo_barra_variante,
-                le.celular_cliente, 
-                le.nombre_cliente, 
-                le.producto_buscado, 
-                le.sucursal_referencia, 
-                le.talle_buscado, 
-                le.color_buscado, 
-                le.notificado, 
-                le.created_at,
-                COALESCE(
-                    (
-                        SELECT json_agg(json_build_object('id', s.id, 'name', s.size_name))
-                        FROM lista_espera_talles let
-                        JOIN sizes s ON s.id = let.size_id
-                        WHERE let.waiting_list_id = le.id
-                    ), '[]'
-                ) as talles_detalle,
-                COALESCE(
-                    (
-                        SELECT json_agg(json_build_object('id', c.id, 'name', c.color_name, 'hex', c.color_hex))
-                        FROM lista_espera_colores lec
-                        JOIN colors c ON c.id = lec.color_id
-                        WHERE lec.waiting_list_id = le.id
-                    ), '[]'
-                ) as colores_detalle
-            FROM lista_espera le
-        """
+        query = SQL_WAITING_LIST_SELECT
         
         # Build WHERE clause dynamically
         where_conditions = []
@@ -148,6 +223,7 @@ async def get_waiting_list(
         logger.info(f"get_waiting_list called with producto={producto}, notificado={notificado}")
         
         if producto:
+            # Infix match, backed by the pg_trgm GIN index (migration 030)
             where_conditions.append(f"le.producto_buscado ILIKE ${arg_counter}")
             args.append(f"%{producto}%")
             arg_counter += 1
@@ -184,24 +260,13 @@ async def get_waiting_list(
         logger.info(f"Final query conditions: {where_conditions}")
         logger.info(f"Query args: {args}")
             
-        query += " ORDER BY le.created_at DESC"
-        
-        rows = await db.fetch_all(query, *args)
+        query += SQL_WAITING_LIST_ORDER
         
-        # Parse JSON strings if necessary (asyncpg usually returns them as strings or dicts depending on config)
-        # But since we used json_agg, it likely comes as a string that Pydantic can parse if we pass it correctly.
-        # However, to be safe, let's map it.
-        import json
-        result = []
-        for row in rows:
-            row_dict = dict(row)
-            if isinstance(row_dict.get('talles_detalle'), str):
-                 row_dict['talles_detalle'] = json.loads(row_dict['talles_detalle'])
-            if isinstance(row_dict.get('colores_detalle'), str):
-                 row_dict['colores_detalle'] = json.loads(row_dict['colores_detalle'])
-            result.append(row_dict)
-            
-        return result
+        # Rows already match WaitingListResponse (talles_detalle / colores_detalle
+        # arrive as lists via the pool JSON codec); stream them from a cursor
+        return await _stream_json_array(query, args)
+    except PoolBusyError:
+        raise pool_busy_exception()
     except Exception as e:
         logger.error(f"Error fetching waiting list: {e}")
         raise HTTPException(
@@ -215,17 +280,22 @@ async def get_waiting_list_stats():
     """
     Get top most requested products (Admin only).
     """
+    # Serve the already-serialized stats if they are still cached
+    cached = waiting_list_stats_cache.get(_STATS_CACHE_KEY)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    
     try:
-        query = """
-            SELECT 
-                producto_buscado, 
-                COUNT(*) as count
-            FROM lista_espera
-            GROUP BY producto_buscado
-            ORDER BY count DESC
-        """
-        rows = await db.fetch_all(query)
-        return rows
+        # Pre-aggregated view, refreshed every few minutes (migration 029),
+        # read in a read-only transaction like the listing
+        async with db.acquire() as conn:
+            async with conn.transaction(readonly=True):
+                rows = await conn.fetch(SQL_WAITING_LIST_STATS)
+        body = dumps([dict(row) for row in rows])
+        waiting_list_stats_cache.set(_STATS_CACHE_KEY, body)
+        return Response(content=body, media_type="application/json")
+    except PoolBusyError:
+        raise pool_busy_exception()
     except Exception as e:
         logger.error(f"Error fetching waiting list stats: {e}")
         raise HTTPException(
@@ -239,12 +309,11 @@ async def delete_waiting_list_request(request_id: int):
     Delete a waiting list request (Admin only).
     """
     try:
-        # Check if exists
-        exists = await db.fetch_val("SELECT id FROM lista_espera WHERE id = $1", request_id)
-        if not exists:
+        # Delete and check existence in one round-trip
+        deleted = await db.fetch_val(SQL_DELETE_WAITING_LIST_REQUEST, request_id)
+        if deleted is None:
             raise HTTPException(status_code=404, detail="Solicitud no encontrada")
 
-        await db.execute("DELETE FROM lista_espera WHERE id = $1", request_id)
         return {"message": "Solicitud eliminada exitosamente"}
     except HTTPException:
         raise
@@ -38,6 +38,57 @@ def _resolve_migration_file() -> str:
     return str(latest)
 
 
+_DOLLAR_TAG = re.compile(r"\$[A-Za-z_]*\$")
+
+# Transaction control inside a file is dropped: the runner already wraps
+# the whole migration in a single transaction
+_TX_CONTROL = {"BEGIN", "BEGIN TRANSACTION", "COMMIT", "END", "START TRANSACTION"}
+
+
+def _split_statements(sql: str) -> list:
+    """
+    Split a migration into its top-level statements on ';'.
+
+    Semicolons inside quotes, dollar-quoted bodies ($$ ... $$, $tag$ ... $tag$)
+    and comments are left alone, so PL/pgSQL functions stay in one piece.
+    """
+    statements = []
+    start = 0
+    i = 0
+    n = len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch == "-" and sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = n if end == -1 else end + 1
+        elif ch == "/" and sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+        elif ch in ("'", '"'):
+            end = sql.find(ch, i + 1)
+            # Doubled quotes ('it''s') just reopen the literal on the next pass
+            i = n if end == -1 else end + 1
+        elif ch == "$" and (tag := _DOLLAR_TAG.match(sql, i)):
+            end = sql.find(tag.group(), tag.end())
+            i = n if end == -1 else end + len(tag.group())
+        elif ch == ";":
+            statements.append(sql[start:i])
+            i += 1
+            start = i
+        else:
+            i += 1
+    statements.append(sql[start:])
+
+    result = []
+    for statement in statements:
+        # Skip chunks that only hold whitespace / comments
+        code = re.sub(r"--[^\n]*", "", statement).strip()
+        if not code or code.upper() in _TX_CONTROL:
+            continue
+        result.append(statement.strip())
+    return result
+
+
 async def r():
     try:
         print("Initializing DB...")
@@ -49,11 +100,24 @@ async def r():
         with open(migration_file, "r") as f:
             sql_content = f.read()
 
-        print("Executing migration...")
-        # Split by semicolon if multiple statements needed, usually execute can handle blocks
-        # asyncpg execute might handle multiple statements if passed as block?
-        # Let's try executing the whole block.
-        await DatabaseManager.execute(sql_content)
+        statements = _split_statements(sql_content)
+        print(f"Executing migration ({len(statements)} statements)...")
+        # One transaction for the whole file; each statement runs on its own
+        # so a failure points at the exact statement
+        pool = await DatabaseManager.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                for i, statement in enumerate(statements, start=1):
+                    summary = next(
+                        line for line in statement.splitlines()
+                        if line.strip() and not line.lstrip().startswith("--")
+                    )
+                    print(f"  [{i}/{len(statements)}] {summary.strip()[:80]}")
+                    try:
+                        await conn.execute(statement)
+                    except Exception:
+                        print(f"Failed statement {i}/{len(statements)}:\n{statement}")
+                        raise
 
         print("Migration executed successfully!")
 
@@ -24,7 +24,9 @@ else
 fi
 
 # Iniciar el servidor con uvicorn en puerto 8080
+# uvloop / httptools vienen con uvicorn[standard]; se fijan explícitamente
+# para que un entorno sin ellos falle al iniciar en vez de caer a asyncio puro
 echo "🌐 Iniciando servidor en 0.0.0.0:8080..."
-uvicorn main:app --host 0.0.0.0 --port 8080 --reload
+uvicorn main:app --host 0.0.0.0 --port 8080 --loop uvloop --http httptools --reload
 
 
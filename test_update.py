@@ -14,11 +14,16 @@ async def main():
         database=os.getenv('DB_NAME', 'mykonos_db')
     )
     
-    rows = await conn.fetch("SELECT id, product_id, size_id, color_id FROM warehouse_stock_variants WHERE length(variant_barcode) = 14 AND variant_barcode LIKE '0%' AND size_id IS NULL;")
-    print(f"Old format with null size_id: {len(rows)}")
-
-    rows2 = await conn.fetch("SELECT id, product_id, size_id, color_id FROM warehouse_stock_variants WHERE length(variant_barcode) = 14 AND variant_barcode LIKE '0%' AND color_id IS NULL;")
-    print(f"Old format with null color_id: {len(rows2)}")
+    # Both counts in one scan / round-trip
+    counts = await conn.fetchrow("""
+        SELECT
+            COUNT(*) FILTER (WHERE size_id IS NULL) AS null_size,
+            COUNT(*) FILTER (WHERE color_id IS NULL) AS null_color
+        FROM warehouse_stock_variants
+        WHERE length(variant_barcode) = 14 AND variant_barcode LIKE '0%'
+    """)
+    print(f"Old format with null size_id: {counts['null_size']}")
+    print(f"Old format with null color_id: {counts['null_color']}")
     
     await conn.close()
 
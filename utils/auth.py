@@ -4,59 +4,178 @@ Provides dependency injection functions for protecting endpoints.
 """
 
 from fastapi import Header, HTTPException, status
-from typing import Optional
-from config.db_connection import DatabaseManager, db
+from typing import Dict, Optional
+from config.db_connection import DatabaseManager
+from utils.responses import pool_busy_exception
+from utils.cache import auth_invalid_token_cache, auth_user_cache, session_profile_cache
+import asyncio
+import asyncpg
+import hashlib
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
+# Session-token lookup behind every authenticated request; prepared on each
+# pool connection (see DatabaseManager.register_hot_statements). Only what
+# authorization and the protected endpoints use; profiles come from /users/me.
+# Served by the partial index idx_web_users_active_session_token (031).
+SQL_AUTH_USER = """
+SELECT id, username, email, fullname, role, status
+FROM web_users
+WHERE session_token = $1 AND status = 'active'
+"""
 
-async def get_current_user(authorization: Optional[str] = Header(None)) -> dict:
+DatabaseManager.register_hot_statements(SQL_AUTH_USER)
+
+# In-flight token lookups, so concurrent misses for one token share a query
+_pending_lookups: Dict[bytes, asyncio.Future] = {}
+
+# Pool used by the token lookups, bound on first use. Auth is its heaviest
+# user; sizing / recycling knobs are the DB_POOL_* settings in config/config.py
+_pool: Optional[asyncpg.Pool] = None
+
+
+async def _get_pool() -> asyncpg.Pool:
+    """Return the shared pool, awaiting DatabaseManager only the first time."""
+    global _pool
+    if _pool is None:
+        _pool = await DatabaseManager.get_pool()
+    return _pool
+
+
+# Shape of every token this API issues: secrets.token_urlsafe(32) (43 chars)
+# and the older str(uuid4()) ones (36 chars, hex + '-')
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_-]{32,64}")
+
+
+def _token_key(token: str) -> bytes:
+    """Cache key for a session token (digest, so raw tokens aren't kept)."""
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+
+def invalidate_token(token: Optional[str]) -> None:
     """
-    Get current authenticated user from Authorization header.
+    Forget every cached lookup of a session token.
+
+    Call whenever a token stops being valid or its user changes under it:
+    logout, token rotation on login, role / status / profile changes. Covers
+    auth_user_cache and routes/user.py's session_profile_cache (both keyed by
+    _token_key). None is a no-op.
+    """
+    if not token:
+        return
+    key = _token_key(token)
+    auth_user_cache.pop(key)
+    session_profile_cache.pop(key)
+
+
+async def _lookup_token(token: str) -> Optional[dict]:
+    """
+    Resolve an active web user from a session token, through auth_user_cache.
+
+    Returns the cached user dict, shared across requests (read-only: callers
+    copy it before changing anything), or None if the token is unknown.
+    """
+    # Malformed tokens can never match; skip the cache and the database
+    if not _TOKEN_RE.fullmatch(token):
+        return None
     
-    Args:
-        authorization: Bearer token from Authorization header
-        
-    Returns:
-        User dictionary with user information
+    key = _token_key(token)
+    user = auth_user_cache.get(key)
+    
+    if user is None:
+        # Recently rejected token (expired session, client retrying it)
+        if auth_invalid_token_cache.get(key):
+            return None
         
-    Raises:
-        HTTPException: If token is missing, invalid, or user not found
+        pending = _pending_lookups.get(key)
+        if pending is not None:
+            # Another request is already querying this token; wait for it
+            user = await asyncio.shield(pending)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            _pending_lookups[key] = future
+            try:
+                pool = _pool or await _get_pool()
+                try:
+                    conn = await pool.acquire(timeout=DatabaseManager.acquire_timeout())
+                except asyncio.TimeoutError:
+                    # Only the acquire wait: surfaces as 503 even through
+                    # callers' generic 500 handlers
+                    raise pool_busy_exception()
+                try:
+                    row = await conn.fetchrow(SQL_AUTH_USER, token)
+                finally:
+                    await pool.release(conn)
+                user = dict(row) if row else None
+                if user is not None:
+                    auth_user_cache.set(key, user)
+                else:
+                    auth_invalid_token_cache.set(key, True)
+                future.set_result(user)
+            except BaseException as e:
+                future.set_exception(e if isinstance(e, Exception) else RuntimeError("token lookup cancelled"))
+                future.exception()  # mark retrieved when nobody else waits
+                raise
+            finally:
+                _pending_lookups.pop(key, None)
+    
+    return user
+
+
+async def _resolve_session(authorization: Optional[str], missing_detail: str, invalid_detail: str) -> dict:
+    """
+    Shared body of the token dependencies: header check, lookup and 401s.
+    
+    Args:
+        authorization: Raw Authorization header value
+        missing_detail: 401 detail when the header is absent or not a Bearer one
+        invalid_detail: 401 detail when the token resolves to no active user
     """
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Missing or invalid authorization header"
+            detail=missing_detail
         )
     
-    token = authorization.replace("Bearer ", "")
-    pool = await DatabaseManager.get_pool()
+    user = await _lookup_token(authorization[7:])
     
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow(
-            """
-            SELECT id, username, fullname, email, phone, domicilio, cuit, 
-                   role, status, profile_image_url, email_verified, created_at
-            FROM web_users
-            WHERE session_token = $1 AND status = 'active'
-            """,
-            token
+    if not user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=invalid_detail
         )
+    
+    return user
+
+
+async def get_current_user(authorization: Optional[str] = Header(None)) -> dict:
+    """
+    Get current authenticated user from Authorization header.
+    
+    Args:
+        authorization: Bearer token from Authorization header
         
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid or expired token"
-            )
+    Returns:
+        User dictionary with user information
         
-        return dict(user)
+    Raises:
+        HTTPException: If token is missing, invalid, or user not found
+    """
+    return await _resolve_session(
+        authorization,
+        "Missing or invalid authorization header",
+        "Invalid or expired token"
+    )
 
 
 async def require_admin(authorization: Optional[str] = Header(None)) -> dict:
     """
     Require admin role for endpoint access.
     Use this as a FastAPI dependency to protect admin-only endpoints.
+    The role is checked on the (usually cached) token lookup, so admin
+    requests normally skip the database entirely.
     
     Args:
         authorization: Bearer token from Authorization header
@@ -96,36 +215,17 @@ async def get_current_web_user(authorization: Optional[str] = Header(None)) -> d
     Raises:
         HTTPException: If token is invalid or user not found
     """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="No se proporcionó token de autenticación"
-        )
-    
-    token = authorization.replace("Bearer ", "")
-    
     try:
-        user = await db.fetch_one(
-            """
-            SELECT id, username, email, fullname, role, status
-            FROM web_users
-            WHERE session_token = $1 AND status = 'active'
-            """,
-            token
+        return await _resolve_session(
+            authorization,
+            "No se proporcionó token de autenticación",
+            "Token inválido o expirado"
         )
         
-        if not user:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido o expirado"
-            )
-        
-        return dict(user)
-        
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error getting current web user: {e}")
+        logger.error("Error getting current web user: %s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Error al verificar autenticación"
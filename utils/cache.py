@@ -0,0 +1,72 @@
+"""
+Small in-process TTL caches for hot read paths.
+Entries live per worker process; short TTLs bound staleness when an
+invalidation happens in another process.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """LRU-bounded mapping whose entries expire ``ttl`` seconds after being set."""
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if missing or expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting the least recently used entry when full."""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        """Drop a single entry (no-op if missing)."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        self._data.clear()
+
+
+# Serialized /purchases/my-purchases responses, keyed by web user id
+purchase_history_cache = TTLCache(ttl=60)
+
+# Full web user profiles (routes/user.py) resolved from a session token, keyed
+# like auth_user_cache; utils.auth.invalidate_token() drops both entries.
+session_profile_cache = TTLCache(ttl=60)
+
+# Successful bcrypt checks, keyed by HMAC(per-process pepper, password + stored
+# hash) so neither value is kept. A password change alters the stored hash,
+# which makes older entries unreachable.
+verified_password_cache = TTLCache(ttl=900, maxsize=4096)
+
+# Serialized /waiting_list/stats response (single entry); the underlying view
+# is only refreshed every few minutes anyway
+waiting_list_stats_cache = TTLCache(ttl=60, maxsize=1)
+
+# Users resolved by utils.auth from a session token, keyed by a blake2b digest
+# of the token (raw tokens are not kept). Logout drops the entry; role /
+# status changes are bounded by the TTL.
+auth_user_cache = TTLCache(ttl=30)
+
+# Session tokens that resolved to no active user, keyed like auth_user_cache.
+# Short-lived and kept apart (and small) so floods of random tokens can't
+# evict valid sessions; new tokens are random, so none can be shadowed.
+auth_invalid_token_cache = TTLCache(ttl=5, maxsize=2048)
@@ -3,11 +3,18 @@ Email configuration and utilities using FastAPI-Mail
 """
 
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
+from fastapi_mail.connection import Connection
+from email.message import EmailMessage
+from email.utils import formataddr, formatdate, make_msgid
+from jinja2 import DictLoader, Environment
 from pydantic import EmailStr
 from typing import List
+import logging
 import os
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 # Email configuration
 conf = ConnectionConfig(
     MAIL_USERNAME=os.getenv("MAIL_USERNAME", ""),
@@ -21,7 +28,6 @@ conf = ConnectionConfig(
     VALIDATE_CERTS=True
 )
 
-# Frontend URL for email links
 # Frontend URL for email links
 FRONTEND_URL = os.getenv("FRONTEND_URL", "https://mykonosboutique.com.ar")
 LOGO_URL = "https://fastapi.mykonosboutique.com.ar/static/assets/logoMks.png"
@@ -30,6 +36,336 @@ LOGO_URL = "https://fastapi.mykonosboutique.com.ar/static/assets/logoMks.png"
 fastmail = FastMail(conf)
 
 
+# ---------------------------------------------------------------------------
+# Templates (Jinja2). Compiled once at import; every value is HTML-escaped, so
+# user input (names, contact messages, addresses) can't inject markup.
+# ---------------------------------------------------------------------------
+
+# Shared layout: logo header, content card and footer. Children fill the
+# heading / content / footer blocks and may `set accent` for the heading rule.
+LAYOUT_TPL = """
+<html>
+    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
+        <div style="max-width: 600px; margin: 0 auto;">
+            <!-- Header -->
+            <div style="text-align: right; padding: 20px 20px 10px 20px;">
+                <img src="{{ logo_url }}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
+                <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
+            </div>
+
+            <!-- Content Container -->
+            <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
+                <h1 style="color: #2c3e50; border-bottom: 3px solid {{ accent|default('#FF6B35') }}; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
+                    {% block heading %}{% endblock +%}
+                </h1>
+{% block content %}{% endblock %}
+                <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
+
+                <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
+                    {% block footer %}© 2025 Mykonos. Todos los derechos reservados.{% endblock +%}
+                </p>
+            </div>
+        </div>
+    </body>
+</html>
+"""
+
+VERIFY_TPL = """{% extends "layout" %}
+{% block heading %}¡Bienvenido a Mykonos!{% endblock %}
+{% block content %}
+                <p>Hola <strong>{{ username }}</strong>,</p>
+
+                <p>Gracias por registrarte en Mykonos. Para completar tu registro y activar tu cuenta,
+                por favor verifica tu dirección de correo electrónico haciendo click en el siguiente enlace:</p>
+
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{{ verification_link }}"
+                       style="background-color: #FF6B35; color: white; padding: 12px 30px;
+                              text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Verificar mi correo
+                    </a>
+                </div>
+
+                <p>O copia y pega este enlace en tu navegador:</p>
+                <p style="background-color: #ffffff; padding: 10px; border-radius: 5px; word-break: break-all; border: 1px solid #dee2e6;">
+                    {{ verification_link }}
+                </p>
+
+                <p style="color: #7f8c8d; font-size: 14px; margin-top: 30px;">
+                    Si no creaste esta cuenta, puedes ignorar este correo.
+                </p>
+{% endblock %}
+"""
+
+WELCOME_TPL = """{% extends "layout" %}
+{% block heading %}¡Bienvenido a Mykonos!{% endblock %}
+{% block content %}
+                <p>Hola <strong>{{ username }}</strong>,</p>
+
+                <p>Gracias por registrarte en Mykonos. ¡Bienvenido a nuestra comunidad!</p>
+
+                <p>Si tienes alguna pregunta o necesitas ayuda, no dudes en contactarnos.</p>
+
+                <p>Visita nuestra tienda virtual en <a href="{{ frontend_url }}" style="color: #FF6B35; text-decoration: none;">{{ frontend_url }}</a></p>
+{% endblock %}
+"""
+
+CONTACT_TPL = """{% extends "layout" %}
+{% block heading %}Nueva Consulta desde la Web{% endblock %}
+{% block content %}
+                <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Datos del Contacto:</h3>
+                    <p><strong>Nombre:</strong> {{ name }}</p>
+                    <p><strong>Email:</strong> {{ email }}</p>
+                    <p><strong>Teléfono:</strong> {{ phone or 'No proporcionado' }}</p>
+                </div>
+
+                <div style="background-color: #ffffff; padding: 20px; border-left: 4px solid #FF6B35; margin: 20px 0; border-top: 1px solid #dee2e6; border-right: 1px solid #dee2e6; border-bottom: 1px solid #dee2e6; border-radius: 0 5px 5px 0;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Mensaje:</h3>
+                    <p style="white-space: pre-line;">{{ message_text }}</p>
+                </div>
+{% endblock %}
+{% block footer %}Sistema de contacto - Mykonos{% endblock %}
+"""
+
+PASSWORD_RESET_TPL = """{% extends "layout" %}
+{% set accent = '#e74c3c' %}
+{% block heading %}Restablecer Contraseña - Mykonos{% endblock %}
+{% block content %}
+                <p>Hola <strong>{{ username }}</strong>,</p>
+
+                <p>Recibimos una solicitud para restablecer la contraseña de tu cuenta.
+                Si no realizaste esta solicitud, puedes ignorar este correo.</p>
+
+                <p>Para restablecer tu contraseña, haz clic en el siguiente enlace:</p>
+
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{{ reset_link }}"
+                       style="background-color: #e74c3c; color: white; padding: 12px 30px;
+                              text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Restablecer Contraseña
+                    </a>
+                </div>
+
+                <p>O copia y pega este enlace en tu navegador:</p>
+                <p style="background-color: #ffffff; padding: 10px; border-radius: 5px; word-break: break-all; border: 1px solid #dee2e6;">
+                    {{ reset_link }}
+                </p>
+
+                <p style="color: #e74c3c; font-size: 14px; margin-top: 30px;">
+                    <strong>Este enlace expirará en 1 hora.</strong>
+                </p>
+{% endblock %}
+"""
+
+ORDER_STATUS_TPL = """{% extends "layout" %}
+{% set accent = '#27ae60' %}
+{% block heading %}Actualización de Pedido - Mykonos{% endblock %}
+{% block content %}
+                <p>Hola <strong>{{ username }}</strong>,</p>
+
+                <p>Tu pedido <strong>#{{ order_id }}</strong> ha sido actualizado:</p>
+
+                <div style="background-color: #e8f5e9; padding: 20px; border-radius: 5px; margin: 20px 0; border-left: 4px solid #27ae60;">
+                    <h3 style="margin-top: 0; color: #27ae60;">Estado: {{ status }}</h3>
+                    <p>{{ description }}</p>
+                </div>
+
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{{ base_url }}/order-tracking/{{ order_id }}"
+                       style="background-color: #27ae60; color: white; padding: 12px 30px;
+                              text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Ver Seguimiento
+                    </a>
+                </div>
+{% endblock %}
+"""
+
+NEW_ORDER_TPL = """{% extends "layout" %}
+{% block heading %}🛍️ Nuevo Pedido Recibido{% endblock %}
+{% block content %}
+                <div style="background-color: #fff3cd; padding: 15px; border-radius: 5px; margin: 20px 0; border-left: 4px solid #FF6B35;">
+                    <h2 style="margin-top: 0; color: #FF6B35;">Pedido #{{ order_id }}</h2>
+                    <p style="font-size: 18px; margin: 5px 0;"><strong>Total Final: ${{ total|money }}</strong></p>
+                    <p style="margin: 5px 0;">Cantidad de productos: {{ items_count }}</p>
+                </div>
+
+                <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Datos del Cliente:</h3>
+                    <p><strong>Nombre:</strong> {{ customer_name }}</p>
+                    <p><strong>Email:</strong> <a href="mailto:{{ customer_email }}" style="color: #FF6B35;">{{ customer_email }}</a></p>
+                    <p><strong>Teléfono:</strong> {{ customer_phone or 'No proporcionado' }}</p>
+                </div>
+
+                <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Detalles de Entrega:</h3>
+                    <p><strong>Tipo:</strong> {{ delivery_type_text }}</p>
+                    <p><strong>Dirección:</strong> {{ shipping_address }}</p>
+                </div>
+{% if items %}
+
+                <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Productos:</h3>
+                    <table style="width: 100%; border-collapse: collapse;">
+                        <thead>
+                            <tr style="border-bottom: 2px solid #dee2e6; text-align: left;">
+                                <th style="padding: 10px;">Producto</th>
+                                <th style="padding: 10px;">Cant.</th>
+                                <th style="padding: 10px;">Precio</th>
+                                <th style="padding: 10px;">Subtotal</th>
+                            </tr>
+                        </thead>
+                        <tbody>
+{% for item in items %}
+                            <tr style="border-bottom: 1px solid #dee2e6;">
+                                <td style="padding: 10px;">{{ item.name }}</td>
+                                <td style="padding: 10px;">{{ item.quantity }}</td>
+                                <td style="padding: 10px;">${{ item.sale_price|money }}
+{%- if item.original_price > item.sale_price -%}
+                                    <br><small style="color: #e74c3c; text-decoration: line-through;">${{ item.original_price|money }}</small>
+                                    <small style="color: #27ae60;">{% if item.discount_pct > 0 %}(-{{ '%g'|format(item.discount_pct) }}%){% else %}(Desc.){% endif %}</small>
+{%- endif -%}
+                                </td>
+                                <td style="padding: 10px;">${{ item.subtotal|money }}</td>
+                            </tr>
+{% endfor %}
+                        </tbody>
+                    </table>
+                </div>
+{% endif %}
+
+                <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Resumen Financiero:</h3>
+                    <p><strong>Subtotal (con desc. prod):</strong> ${{ (total - shipping_cost + coupon_discount)|money }}</p>
+                    <p><strong>Costo de Envío:</strong> ${{ shipping_cost|money }}</p>
+{% if coupon_discount > 0 %}
+                    <p><strong>Descuento por Cupón:</strong> -${{ coupon_discount|money }}</p>
+{% endif %}
+                </div>
+
+                <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Notas del Cliente:</h3>
+                    <p>{{ customer_notes or 'Sin notas adicionales' }}</p>
+                </div>
+
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{{ order_link }}"
+                       style="background-color: #FF6B35; color: white; padding: 12px 30px;
+                              text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Ver Pedido Completo
+                    </a>
+                </div>
+{% endblock %}
+{% block footer %}Sistema de notificaciones - Mykonos Boutique{% endblock %}
+"""
+
+READY_FOR_PICKUP_TPL = """{% extends "layout" %}
+{% block heading %}¡Tu pedido está listo! 🛍️{% endblock %}
+{% block content %}
+                <p>Hola <strong>{{ username }}</strong>,</p>
+
+                <p>Nos alegra informarte que tu pedido <strong>#{{ order_id }}</strong> ya está listo para ser retirado.</p>
+
+                <div style="background-color: #fff3cd; padding: 20px; border-radius: 5px; margin: 20px 0; border-left: 4px solid #FF6B35;">
+                    <h3 style="margin-top: 0; color: #2c3e50;">Información de Retiro:</h3>
+                    <p><strong>📍 Dirección:</strong> {{ pickup_address }}</p>
+                    <p><strong>🕒 Horarios:</strong> {{ schedule }}</p>
+                    <p><strong>📝 Requisitos:</strong> Por favor presenta tu número de pedido ({{ order_id }}) o tu DNI al retirar.</p>
+                </div>
+
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{{ base_url }}/order-tracking/{{ order_id }}"
+                       style="background-color: #FF6B35; color: white; padding: 12px 30px;
+                              text-decoration: none; border-radius: 5px; display: inline-block;">
+                        Ver Detalles del Pedido
+                    </a>
+                </div>
+{% endblock %}
+"""
+
+# Broadcasts have their own look (web fonts, footer link), so no shared layout
+BROADCAST_TPL = """
+<html>
+    <head>
+        <style>
+            @import url('https://fonts.googleapis.com/css2?family=Playfair+Display:wght@400;700&family=Lato:wght@400;700&display=swap');
+        </style>
+    </head>
+    <body style="font-family: 'Lato', 'Helvetica Neue', Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
+        <div style="max-width: 600px; margin: 0 auto;">
+
+            <!-- Header -->
+            <div style="text-align: right; padding: 20px 20px 10px 20px;">
+                <img src="{{ logo_url }}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
+                <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
+            </div>
+
+            <!-- Body -->
+            <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
+                <h2 style="color: #2c3e50; margin-top: 0; margin-bottom: 25px; font-family: 'Playfair Display', serif; font-size: 28px; text-align: left;">
+                    {{ title }}
+                </h2>
+{% if image_url %}
+
+                <div style="margin: 20px 0; text-align: center;">
+                    <img src="{{ image_url }}" alt="{{ title }}" style="max-width: 100%; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
+                </div>
+{% endif %}
+
+                <div style="font-size: 16px; color: #444; white-space: pre-line; text-align: left; padding: 0;">{{ message_text }}</div>
+{% if link_url %}
+
+                <div style="text-align: center; margin: 30px 0;">
+                    <a href="{{ link_url }}"
+                       style="background-color: #FF6B35; color: white; padding: 12px 30px;
+                              text-decoration: none; border-radius: 5px; display: inline-block; font-weight: bold; font-family: 'Playfair Display', serif;">
+                        Ver Más
+                    </a>
+                </div>
+{% endif %}
+
+                <!-- Footer -->
+                <div style="margin-top: 30px; padding-top: 20px; text-align: center; font-size: 12px; color: #7f8c8d; border-top: 1px solid #dcdcdc;">
+                    <p style="margin: 5px 0;">© 2025 Mykonos Boutique. Todos los derechos reservados.</p>
+                    <p style="margin: 5px 0;">
+                        <a href="{{ base_url }}" style="color: #FF6B35; text-decoration: none;">Visitar Tienda</a>
+                    </p>
+                </div>
+            </div>
+
+        </div>
+    </body>
+</html>
+"""
+
+
+def _money(value: float) -> str:
+    """Format an amount the way the emails show prices (1,234.50)."""
+    return f"{value:,.2f}"
+
+
+_ENV = Environment(
+    loader=DictLoader({
+        "layout": LAYOUT_TPL,
+        "verify": VERIFY_TPL,
+        "welcome": WELCOME_TPL,
+        "contact": CONTACT_TPL,
+        "password_reset": PASSWORD_RESET_TPL,
+        "order_status": ORDER_STATUS_TPL,
+        "new_order": NEW_ORDER_TPL,
+        "ready_for_pickup": READY_FOR_PICKUP_TPL,
+        "broadcast": BROADCAST_TPL,
+    }),
+    autoescape=True,
+    trim_blocks=True,
+    auto_reload=False,
+)
+_ENV.filters["money"] = _money
+_ENV.globals["logo_url"] = LOGO_URL
+
+_TEMPLATES = {name: _ENV.get_template(name) for name in _ENV.list_templates() if name != "layout"}
+
+
 async def send_verification_email(email: str, username: str, verification_token: str, base_url: str = FRONTEND_URL):
     """
     Send email verification email to new user
@@ -42,59 +378,10 @@ async def send_verification_email(email: str, username: str, verification_token:
     """
     verification_link = f"{base_url}/verify-email?token={verification_token}"
     
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-                
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #FF6B35; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        ¡Bienvenido a Mykonos!
-                    </h1>
-                    
-                    <p>Hola <strong>{username}</strong>,</p>
-                    
-                    <p>Gracias por registrarte en Mykonos. Para completar tu registro y activar tu cuenta, 
-                    por favor verifica tu dirección de correo electrónico haciendo click en el siguiente enlace:</p>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="{verification_link}" 
-                           style="background-color: #FF6B35; color: white; padding: 12px 30px; 
-                                  text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Verificar mi correo
-                        </a>
-                    </div>
-                    
-                    <p>O copia y pega este enlace en tu navegador:</p>
-                    <p style="background-color: #ffffff; padding: 10px; border-radius: 5px; word-break: break-all; border: 1px solid #dee2e6;">
-                        {verification_link}
-                    </p>
-                    
-                    <p style="color: #7f8c8d; font-size: 14px; margin-top: 30px;">
-                        Si no creaste esta cuenta, puedes ignorar este correo.
-                    </p>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        © 2025 Mykonos. Todos los derechos reservados.
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
-    
     message = MessageSchema(
         subject="Verifica tu correo - Mykonos",
         recipients=[email],
-        body=html_content.format(LOGO_URL=LOGO_URL, username=username, verification_link=verification_link),
+        body=_TEMPLATES["verify"].render(username=username, verification_link=verification_link),
         subtype=MessageType.html
     )
     
@@ -108,45 +395,10 @@ async def send_welcome_email(email: str, username: str):
         email: User's email address
         username: User's username
     """
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #FF6B35; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        ¡Bienvenido a Mykonos!
-                    </h1>
-                    
-                    <p>Hola <strong>{username}</strong>,</p>
-                    
-                    <p>Gracias por registrarte en Mykonos. ¡Bienvenido a nuestra comunidad!</p>
-                    
-                    <p>Si tienes alguna pregunta o necesitas ayuda, no dudes en contactarnos.</p>
-                    
-                    <p>Visita nuestra tienda virtual en <a href="{FRONTEND_URL}" style="color: #FF6B35; text-decoration: none;">{FRONTEND_URL}</a></p>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        © 2025 Mykonos. Todos los derechos reservados.
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
-    
     message = MessageSchema(
         subject="¡Bienvenido a Mykonos!",
         recipients=[email],
-        body=html_content,
+        body=_TEMPLATES["welcome"].render(username=username, frontend_url=FRONTEND_URL),
         subtype=MessageType.html
     )
     
@@ -163,49 +415,10 @@ async def send_contact_email(name: str, email: str, phone: str, message_text: st
         phone: Sender's phone (optional)
         message_text: Message content
     """
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #FF6B35; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        Nueva Consulta desde la Web
-                    </h1>
-                    
-                    <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
-                        <h3 style="margin-top: 0; color: #2c3e50;">Datos del Contacto:</h3>
-                        <p><strong>Nombre:</strong> {name}</p>
-                        <p><strong>Email:</strong> {email}</p>
-                        <p><strong>Teléfono:</strong> {phone if phone else 'No proporcionado'}</p>
-                    </div>
-                    
-                    <div style="background-color: #ffffff; padding: 20px; border-left: 4px solid #FF6B35; margin: 20px 0; border-top: 1px solid #dee2e6; border-right: 1px solid #dee2e6; border-bottom: 1px solid #dee2e6; border-radius: 0 5px 5px 0;">
-                        <h3 style="margin-top: 0; color: #2c3e50;">Mensaje:</h3>
-                        <p style="white-space: pre-line;">{message_text}</p>
-                    </div>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        Sistema de contacto - Mykonos
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
-    
     message = MessageSchema(
         subject=f"Nueva consulta desde la web - {name}",
         recipients=["mykonosboutique733@gmail.com"],
-        body=html_content.format(LOGO_URL=LOGO_URL, name=name, email=email, phone=phone if phone else 'No proporcionado', message_text=message_text),
+        body=_TEMPLATES["contact"].render(name=name, email=email, phone=phone, message_text=message_text),
         subtype=MessageType.html,
         reply_to=[email]  # Allow direct reply to customer
     )
@@ -225,61 +438,10 @@ async def send_password_reset_email(email: str, username: str, reset_token: str,
     """
     reset_link = f"{base_url}/reset-password?token={reset_token}"
     
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #e74c3c; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        Restablecer Contraseña - Mykonos
-                    </h1>
-                    
-                    <p>Hola <strong>{username}</strong>,</p>
-                    
-                    <p>Recibimos una solicitud para restablecer la contraseña de tu cuenta. 
-                    Si no realizaste esta solicitud, puedes ignorar este correo.</p>
-                    
-                    <p>Para restablecer tu contraseña, haz clic en el siguiente enlace:</p>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="{reset_link}" 
-                           style="background-color: #e74c3c; color: white; padding: 12px 30px; 
-                                  text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Restablecer Contraseña
-                        </a>
-                    </div>
-                    
-                    <p>O copia y pega este enlace en tu navegador:</p>
-                    <p style="background-color: #ffffff; padding: 10px; border-radius: 5px; word-break: break-all; border: 1px solid #dee2e6;">
-                        {reset_link}
-                    </p>
-                    
-                    <p style="color: #e74c3c; font-size: 14px; margin-top: 30px;">
-                        <strong>Este enlace expirará en 1 hora.</strong>
-                    </p>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        © 2025 Mykonos. Todos los derechos reservados.
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
-    
     message = MessageSchema(
         subject="Restablecer contraseña - Mykonos",
         recipients=[email],
-        body=html_content.format(LOGO_URL=LOGO_URL, username=username, reset_link=reset_link),
+        body=_TEMPLATES["password_reset"].render(username=username, reset_link=reset_link),
         subtype=MessageType.html
     )
     
@@ -297,54 +459,16 @@ async def send_order_status_email(email: str, username: str, order_id: int, stat
         status: New status
         description: Status description
     """
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #27ae60; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        Actualización de Pedido - Mykonos
-                    </h1>
-                    
-                    <p>Hola <strong>{username}</strong>,</p>
-                    
-                    <p>Tu pedido <strong>#{order_id}</strong> ha sido actualizado:</p>
-                    
-                    <div style="background-color: #e8f5e9; padding: 20px; border-radius: 5px; margin: 20px 0; border-left: 4px solid #27ae60;">
-                        <h3 style="margin-top: 0; color: #27ae60;">Estado: {status}</h3>
-                        <p>{description}</p>
-                    </div>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="{base_url}/order-tracking/{order_id}" 
-                           style="background-color: #27ae60; color: white; padding: 12px 30px; 
-                                  text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Ver Seguimiento
-                        </a>
-                    </div>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        © 2025 Mykonos. Todos los derechos reservados.
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
-    
     message = MessageSchema(
         subject=f"Actualización de pedido #{order_id} - Mykonos",
         recipients=[email],
-        body=html_content.format(LOGO_URL=LOGO_URL, username=username, order_id=order_id, status=status, description=description, base_url=base_url),
+        body=_TEMPLATES["order_status"].render(
+            username=username,
+            order_id=order_id,
+            status=status,
+            description=description,
+            base_url=base_url
+        ),
         subtype=MessageType.html
     )
     
@@ -384,130 +508,38 @@ async def send_new_order_notification_to_business(
     """
     delivery_type_text = "Envío a domicilio" if delivery_type == "envio" else "Retiro en sucursal"
     
-    items_html = ""
-    if items:
-        items_html = """
-        <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
-            <h3 style="margin-top: 0; color: #2c3e50;">Productos:</h3>
-            <table style="width: 100%; border-collapse: collapse;">
-                <thead>
-                    <tr style="border-bottom: 2px solid #dee2e6; text-align: left;">
-                        <th style="padding: 10px;">Producto</th>
-                        <th style="padding: 10px;">Cant.</th>
-                        <th style="padding: 10px;">Precio</th>
-                        <th style="padding: 10px;">Subtotal</th>
-                    </tr>
-                </thead>
-                <tbody>
-        """
-        for item in items:
-            product_name = f"{item['product_name']} ({item['size_name']}, {item['color_name']})"
-            original_price = float(item.get('original_price', item['sale_price']))
-            sale_price = float(item['sale_price'])
-            quantity = int(item['quantity'])
-            
-            price_text = f"${sale_price:,.2f}"
-            if original_price > sale_price:
-                discount_pct = float(item.get('current_discount_percentage', 0))
-                if discount_pct > 0:
-                     price_text += f"<br><small style='color: #e74c3c; text-decoration: line-through;'>${original_price:,.2f}</small> <small style='color: #27ae60;'>(-{discount_pct:g}%)</small>"
-                else:
-                     price_text += f"<br><small style='color: #e74c3c; text-decoration: line-through;'>${original_price:,.2f}</small> <small style='color: #27ae60;'>(Desc.)</small>"
-            
-            subtotal = sale_price * quantity
-            
-            items_html += f"""
-                    <tr style="border-bottom: 1px solid #dee2e6;">
-                        <td style="padding: 10px;">{product_name}</td>
-                        <td style="padding: 10px;">{quantity}</td>
-                        <td style="padding: 10px;">{price_text}</td>
-                        <td style="padding: 10px;">${subtotal:,.2f}</td>
-                    </tr>
-            """
-        items_html += """
-                </tbody>
-            </table>
-        </div>
-        """
-
-    financial_details = f"""
-        <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
-            <h3 style="margin-top: 0; color: #2c3e50;">Resumen Financiero:</h3>
-            <p><strong>Subtotal (con desc. prod):</strong> ${(total - shipping_cost + coupon_discount):,.2f}</p>
-            <p><strong>Costo de Envío:</strong> ${shipping_cost:,.2f}</p>
-    """
-    if coupon_discount > 0:
-        financial_details += f"<p><strong>Descuento por Cupón:</strong> -${coupon_discount:,.2f}</p>"
-        
-    financial_details += "</div>"
-    
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #FF6B35; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        🛍️ Nuevo Pedido Recibido
-                    </h1>
-                    
-                    <div style="background-color: #fff3cd; padding: 15px; border-radius: 5px; margin: 20px 0; border-left: 4px solid #FF6B35;">
-                        <h2 style="margin-top: 0; color: #FF6B35;">Pedido #{order_id}</h2>
-                        <p style="font-size: 18px; margin: 5px 0;"><strong>Total Final: ${total:,.2f}</strong></p>
-                        <p style="margin: 5px 0;">Cantidad de productos: {items_count}</p>
-                    </div>
-                    
-                    <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
-                        <h3 style="margin-top: 0; color: #2c3e50;">Datos del Cliente:</h3>
-                        <p><strong>Nombre:</strong> {customer_name}</p>
-                        <p><strong>Email:</strong> <a href="mailto:{customer_email}" style="color: #FF6B35;">{customer_email}</a></p>
-                        <p><strong>Teléfono:</strong> {customer_phone if customer_phone else 'No proporcionado'}</p>
-                    </div>
-                    
-                    <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
-                        <h3 style="margin-top: 0; color: #2c3e50;">Detalles de Entrega:</h3>
-                        <p><strong>Tipo:</strong> {delivery_type_text}</p>
-                        <p><strong>Dirección:</strong> {shipping_address}</p>
-                    </div>
-
-                    {{items_html}}
-                    
-                    {{financial_details}}
-
-                    <div style="background-color: #ffffff; padding: 20px; border-radius: 5px; margin: 20px 0; border: 1px solid #dee2e6;">
-                        <h3 style="margin-top: 0; color: #2c3e50;">Notas del Cliente:</h3>
-                        <p>{customer_notes if customer_notes else 'Sin notas adicionales'}</p>
-                    </div>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="{order_link}" 
-                           style="background-color: #FF6B35; color: white; padding: 12px 30px; 
-                                  text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Ver Pedido Completo
-                        </a>
-                    </div>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        Sistema de notificaciones - Mykonos Boutique
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
+    # Product table rows (prices as floats; the template formats them)
+    item_rows = []
+    for item in items or ():
+        sale_price = float(item['sale_price'])
+        quantity = int(item['quantity'])
+        item_rows.append({
+            "name": f"{item['product_name']} ({item['size_name']}, {item['color_name']})",
+            "quantity": quantity,
+            "sale_price": sale_price,
+            "original_price": float(item.get('original_price', item['sale_price'])),
+            "discount_pct": float(item.get('current_discount_percentage') or 0),
+            "subtotal": sale_price * quantity,
+        })
     
     message = MessageSchema(
         subject=f"Nuevo Pedido #{order_id} - ${total:,.2f}",
         recipients=[business_email],
-        body=html_content.format(LOGO_URL=LOGO_URL, order_id=order_id, total=total, items_count=items_count, customer_name=customer_name, customer_email=customer_email, customer_phone=customer_phone if customer_phone else 'No proporcionado', delivery_type_text=delivery_type_text, shipping_address=shipping_address, order_link=order_link, customer_notes=customer_notes if customer_notes else 'Sin notas adicionales', items_html=items_html, financial_details=financial_details),
+        body=_TEMPLATES["new_order"].render(
+            order_id=order_id,
+            total=total,
+            items_count=items_count,
+            customer_name=customer_name,
+            customer_email=customer_email,
+            customer_phone=customer_phone,
+            delivery_type_text=delivery_type_text,
+            shipping_address=shipping_address,
+            order_link=order_link,
+            customer_notes=customer_notes,
+            items=item_rows,
+            shipping_cost=shipping_cost,
+            coupon_discount=coupon_discount
+        ),
         subtype=MessageType.html,
         reply_to=[customer_email]  # Allow direct reply to customer
     )
@@ -533,66 +565,16 @@ async def send_ready_for_pickup_email(
         pickup_address: Address where to pick up the order
         schedule: Pickup schedule
     """
-    html_content = f"""
-    <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-
-                <!-- Content Container -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h1 style="color: #2c3e50; border-bottom: 3px solid #FF6B35; padding-bottom: 10px; margin-top: 0; font-family: 'Playfair Display', serif;">
-                        ¡Tu pedido está listo! 🛍️
-                    </h1>
-                    
-                    <p>Hola <strong>{username}</strong>,</p>
-                    
-                    <p>Nos alegra informarte que tu pedido <strong>#{order_id}</strong> ya está listo para ser retirado.</p>
-                    
-                    <div style="background-color: #fff3cd; padding: 20px; border-radius: 5px; margin: 20px 0; border-left: 4px solid #FF6B35;">
-                        <h3 style="margin-top: 0; color: #2c3e50;">Información de Retiro:</h3>
-                        <p><strong>📍 Dirección:</strong> {{pickup_address}}</p>
-                        <p><strong>🕒 Horarios:</strong> {{schedule}}</p>
-                        <p><strong>📝 Requisitos:</strong> Por favor presenta tu número de pedido ({{order_id}}) o tu DNI al retirar.</p>
-                    </div>
-                    
-                    <div style="text-align: center; margin: 30px 0;">
-                        <a href="{{base_url}}/order-tracking/{{order_id}}" 
-                           style="background-color: #FF6B35; color: white; padding: 12px 30px; 
-                                  text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Ver Detalles del Pedido
-                        </a>
-                    </div>
-                    
-                    <hr style="border: none; border-top: 1px solid #dcdcdc; margin: 30px 0;">
-                    
-                    <p style="color: #7f8c8d; font-size: 12px; text-align: center;">
-                        © 2025 Mykonos. Todos los derechos reservados.
-                    </p>
-                </div>
-            </div>
-        </body>
-    </html>
-    """
-    
-    # Format the content
-    html_content = html_content.format(
-        LOGO_URL=LOGO_URL,
-        username=username,
-        order_id=order_id,
-        pickup_address=pickup_address,
-        schedule=schedule,
-        base_url=base_url
-    )
-    
     message = MessageSchema(
         subject=f"¡Tu pedido #{order_id} está listo para retirar! - Mykonos",
         recipients=[email],
-        body=html_content,
+        body=_TEMPLATES["ready_for_pickup"].render(
+            username=username,
+            order_id=order_id,
+            pickup_address=pickup_address,
+            schedule=schedule,
+            base_url=base_url
+        ),
         subtype=MessageType.html
     )
     
@@ -609,7 +591,8 @@ async def send_broadcast_email(
 ):
     """
     Send broadcast email to multiple recipients.
-    Uses BCC to hide recipient emails.
+    Uses BCC to hide recipient emails; batches share one SMTP session and
+    any left unsent when it fails are retried individually.
     
     Args:
         recipients: List of email addresses
@@ -619,109 +602,73 @@ async def send_broadcast_email(
         link_url: Optional action link
         base_url: Frontend base URL
     """
-    
-    # Construct image HTML if provided
-    image_html = ""
-    if image_url:
-        image_html = f"""
-        <div style="margin: 20px 0; text-align: center;">
-            <img src="{image_url}" alt="{title}" style="max-width: 100%; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-        </div>
-        """
-        
-    # Construct button HTML if link provided
-    button_html = ""
     # Fix link structure if necessary
     if link_url:
         if link_url.startswith("/") and not link_url.startswith("//"):
             # It's a relative path, append domain
-            # Remove leading slash from path to avoid double slashes if base_url has one (though FRONTEND_URL usually doesn't end with slash)
-            # Actually, standard is to strict join
-             link_url = f"{FRONTEND_URL}{link_url}"
+            link_url = f"{FRONTEND_URL}{link_url}"
         elif not link_url.startswith("http"):
-             # Assuming it's a relative path without leading slash or just needs https
-             # Safest is to assume relative if no protocol
-             link_url = f"{FRONTEND_URL}/{link_url}"
-
-    # Construct button HTML if link provided
-    button_html = ""
-    if link_url:
-        button_html = f"""
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="{link_url}" 
-               style="background-color: #FF6B35; color: white; padding: 12px 30px; 
-                      text-decoration: none; border-radius: 5px; display: inline-block; font-weight: bold; font-family: 'Playfair Display', serif;">
-                Ver Más
-            </a>
-        </div>
-        """
-    
-    html_content = f"""
-    <html>
-        <head>
-            <style>
-                @import url('https://fonts.googleapis.com/css2?family=Playfair+Display:wght@400;700&family=Lato:wght@400;700&display=swap');
-            </style>
-        </head>
-        <body style="font-family: 'Lato', 'Helvetica Neue', Arial, sans-serif; line-height: 1.6; color: #333; background-color: #ffffff; margin: 0; padding: 0;">
-            <div style="max-width: 600px; margin: 0 auto;">
-                
-                <!-- Header -->
-                <div style="text-align: right; padding: 20px 20px 10px 20px;">
-                    <img src="{LOGO_URL}" alt="Mykonos Logo" style="max-width: 60px; vertical-align: middle;">
-                    <span style="font-family: 'Playfair Display', serif; font-size: 22px; vertical-align: middle; margin-left: 10px; color: #000000; font-weight: bold;">Mykonos Boutique</span>
-                </div>
-                
-                <!-- Body -->
-                <div style="background-color: #f8f9fa; padding: 30px; border-radius: 8px; margin: 0 20px 30px 20px;">
-                    <h2 style="color: #2c3e50; margin-top: 0; margin-bottom: 25px; font-family: 'Playfair Display', serif; font-size: 28px; text-align: left;">
-                        {title}
-                    </h2>
-                    
-                    {image_html}
-                    
-                    <div style="font-size: 16px; color: #444; white-space: pre-line; text-align: left; padding: 0;">
-                        {message_text}
-                    </div>
-                    
-                    {button_html}
-                    
-                    <!-- Footer -->
-                    <div style="margin-top: 30px; padding-top: 20px; text-align: center; font-size: 12px; color: #7f8c8d; border-top: 1px solid #dcdcdc;">
-                        <p style="margin: 5px 0;">© 2025 Mykonos Boutique. Todos los derechos reservados.</p>
-                        <p style="margin: 5px 0;">
-                            <a href="{base_url}" style="color: #FF6B35; text-decoration: none;">Visitar Tienda</a>
-                        </p>
-                    </div>
-                </div>
-                
-            </div>
-        </body>
-    </html>
-    """
+            # Assuming it's a relative path without leading slash or just needs https
+            # Safest is to assume relative if no protocol
+            link_url = f"{FRONTEND_URL}/{link_url}"
+    
+    # Rendered once and shared by every batch
+    html_content = _TEMPLATES["broadcast"].render(
+        title=title,
+        message_text=message_text,
+        image_url=image_url,
+        link_url=link_url,
+        base_url=base_url
+    )
     
-    # Send in batches of 50 to avoid limits
+    # Batches of 50 BCC recipients to avoid limits
     chunk_size = 50
     sender_email = os.getenv("MAIL_FROM", "mykonosboutique733@gmail.com")
+    batches = [recipients[i:i + chunk_size] for i in range(0, len(recipients), chunk_size)]
     
-    # Log details
-    print(f"Sending broadcast '{title}' to {len(recipients)} recipients")
+    logger.info("Sending broadcast '%s' to %d recipients in %d batches", title, len(recipients), len(batches))
     
-    for i in range(0, len(recipients), chunk_size):
-        chunk = recipients[i:i + chunk_size]
-        
+    # All batches over one SMTP session (one connect / STARTTLS / login),
+    # in order, so on failure everything from `sent` on is still pending
+    sent = 0
+    if not conf.SUPPRESS_SEND:  # suppressed (tests): FastMail records them below
+        try:
+            async with Connection(conf) as connection:
+                for batch in batches:
+                    await connection.session.send_message(
+                        _broadcast_message(title, sender_email, batch, html_content)
+                    )
+                    sent += 1
+        except Exception as e:
+            logger.warning(
+                "Broadcast '%s': shared SMTP session failed after %d/%d batches (%s); retrying the rest one by one",
+                title, sent, len(batches), e
+            )
+    
+    # Unsent batches each get their own connection; a failing one is skipped
+    for i in range(sent, len(batches)):
         message = MessageSchema(
             subject=title,
             recipients=[sender_email], # Required "To" field, using sender
-            bcc=chunk,
+            bcc=batches[i],
             body=html_content,
             subtype=MessageType.html
         )
-        
         try:
             await fastmail.send_message(message)
         except Exception as e:
-            print(f"Error sending broadcast batch {i}: {e}")
-
-
-
+            logger.error("Error sending broadcast '%s' batch %d: %s", title, i, e)
+
+
+def _broadcast_message(subject: str, sender: str, bcc: List[str], html: str) -> EmailMessage:
+    """One broadcast batch as a MIME message (the SMTP client sends to Bcc and strips it)."""
+    message = EmailMessage()
+    message["Subject"] = subject
+    # Same From header fastapi-mail builds for the other emails
+    message["From"] = formataddr((conf.MAIL_FROM_NAME, conf.MAIL_FROM))
+    message["To"] = sender  # Required "To" field, using sender
+    message["Bcc"] = ", ".join(bcc)
+    message["Date"] = formatdate(localtime=True)
+    message["Message-ID"] = make_msgid()
+    message.set_content(html, subtype="html")
+    return message
@@ -0,0 +1,40 @@
+"""
+Background queue for transactional emails.
+Handlers enqueue sends and return immediately; a long-running worker
+started from main.py's lifespan performs the SMTP calls.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+_email_queue: asyncio.Queue = asyncio.Queue()
+
+
+def enqueue_email(send: Callable[..., Awaitable[Any]], *args, **kwargs) -> None:
+    """Schedule ``await send(*args, **kwargs)`` on the email worker."""
+    _email_queue.put_nowait((send, args, kwargs))
+
+
+async def run_email_worker():
+    """Consume the email queue forever, logging (not raising) send failures."""
+    while True:
+        send, args, kwargs = await _email_queue.get()
+        try:
+            await send(*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error sending email via {send.__name__}: {e}")
+        finally:
+            _email_queue.task_done()
+
+
+async def drain_email_queue(timeout: float = 10):
+    """Wait (bounded) for queued emails to be sent, e.g. before shutdown."""
+    try:
+        await asyncio.wait_for(_email_queue.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Shutting down with {_email_queue.qsize()} unsent emails")
@@ -0,0 +1,49 @@
+"""
+Fast JSON response rendering based on orjson.
+Used as the application's default response class.
+"""
+
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+
+# Seconds a client should wait before retrying when the pool is exhausted
+POOL_BUSY_RETRY_AFTER = 1
+
+
+def _default(obj: Any) -> Any:
+    """Serialize types orjson does not handle natively (NUMERIC → float)."""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """Serialize content to JSON bytes (datetimes as ISO 8601, Decimals as floats)."""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson instead of the stdlib json module."""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def pool_busy_exception() -> HTTPException:
+    """
+    503 for a request that timed out waiting for a pool connection.
+
+    Raised instead of the bare asyncio.TimeoutError so handlers that re-raise
+    HTTPException (and clients honouring Retry-After) treat it as retryable.
+    """
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Servidor ocupado, reintentá en unos segundos",
+        headers={"Retry-After": str(POOL_BUSY_RETRY_AFTER)}
+    )
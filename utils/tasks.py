@@ -77,3 +77,15 @@ async def deactivate_expired_coupons():
 
     except Exception as e:
         logger.error(f"Error execution coupon cleanup task: {e}")
+
+
+async def refresh_waiting_list_stats():
+    """
+    Refreshes the mv_waiting_list_stats materialized view (migration 029).
+    CONCURRENTLY keeps /waiting_list/stats readable during the refresh.
+    This should be run periodically.
+    """
+    try:
+        await db.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_waiting_list_stats")
+    except Exception as e:
+        logger.error(f"Error execution waiting list stats refresh task: {e}")